@@ -1,46 +1,318 @@
+import os
 from datetime import datetime
 
-from flask import Flask, render_template, request, redirect, url_for
-from decouple import config
-
-from models import db, connect_db, User, Post, Tag, PostTag
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = config('SQLALCHEMY_DATABASE_URI')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-
-connect_db(app)
-db.create_all()
-
-
-def filter_tags_and_save(tags, other_id, form):
-    for tag in tags:
-        if tag.name in form:
-            pt = PostTag(post_id=other_id, tag_id=tag.id)
-            db.session.add(pt)
-            db.session.commit()
-    return
-
-@app.route('/')
+from flask import (Blueprint, Flask, Response, abort, current_app, render_template, request, redirect, send_file,
+                   send_from_directory, url_for)
+from jinja2 import FileSystemBytecodeCache
+from decouple import Csv, config
+from sqlalchemy import func, inspect, select
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import db, connect_db, pool_options, DEFAULT_IMAGE_URL, User, Post, Tag, PostTag
+from pagination import decode_cursor, keyset_filter, keyset_page, keyset_result
+from instrumentation import init_query_counter, init_request_metrics, pool_metrics, register_metrics, render_metrics
+from cache import Cache, LRUCache, memcached_backend, watch
+from pagecache import conditional_page, streamed_page
+from search import SearchUnavailable, search_posts
+from cli import blogly
+from counters import post_added, post_deleted, user_deleted, tags_changed
+from avatars import AvatarError, AvatarStore, avatar_version
+from replicas import init_replica_routing, primary_reads, replica_reads
+
+def make_cache_backend(settings):
+    """The backend named by CACHE_BACKEND: 'local' for an
+       in-process LRU, or 'memcached' to share one cache
+       between worker processes.
+
+       A local cache only sees the writes made in its own process,
+       so with more than one worker (WEB_CONCURRENCY, which gunicorn
+       also reads) the others would keep serving what they cached
+       before. The local cache is off in that case."""
+    if settings['CACHE_BACKEND'] == 'memcached':
+        return memcached_backend(settings['CACHE_URL'], settings['CACHE_TTL'])
+    maxsize = settings['CACHE_MAXSIZE'] if settings['WEB_CONCURRENCY'] <= 1 else 0
+    return LRUCache(maxsize=maxsize, ttl=settings['CACHE_TTL'])
+
+
+def cache_entries_for(obj):
+    """The cached entries that a User, Post, Tag or PostTag
+       written through the session feeds. Only attributes
+       that are already loaded are read, so this never
+       queries in the middle of a flush."""
+    loaded = inspect(obj).dict
+
+    def entry(namespace, key):
+        return (namespace, None if key is None else str(key))
+
+    if isinstance(obj, User):
+        return [entry('user', loaded.get('id')), entry('user_page', loaded.get('id')),
+                ('users_page', None), ('post_page', None), ('feed_page', None)]
+    if isinstance(obj, Post):
+        return [entry('user', loaded.get('user_id')),
+                entry('post_page', loaded.get('id')), entry('user_page', loaded.get('user_id')),
+                ('tag_page', None), ('feed_page', None)]
+    if isinstance(obj, Tag):
+        return [('tags', 'all'), ('tags', 'popular'), entry('tag', loaded.get('id')),
+                ('tags_page', None), entry('tag_page', loaded.get('id')), ('post_page', None)]
+    if isinstance(obj, PostTag):
+        return [entry('tag_page', loaded.get('tag_id')), entry('post_page', loaded.get('post_id'))]
+    return []
+
+
+def current_cache():
+    """The Cache create_app made for the current app."""
+    return current_app.extensions['blogly_cache']
+
+
+def session_cache(session):
+    """The Cache of the app a session works for, if it has one."""
+    return session.app.extensions.get('blogly_cache')
+
+
+watch(db.session, session_cache, cache_entries_for, table_namespaces={
+    'users': ['user', 'user_page', 'users_page', 'post_page', 'tag_page', 'feed_page'],
+    'posts': ['user', 'user_page', 'post_page', 'tag_page', 'feed_page'],
+    'tags': ['tags', 'tag', 'tags_page', 'tag_page', 'post_page'],
+    'posttags': ['tag_page', 'post_page'],
+})
+
+bp = Blueprint('blogly', __name__)
+
+
+def load_all_tags():
+    tags = db.session.query(Tag.id, Tag.name, Tag.post_count).order_by(Tag.id)
+    return [dict(id=tag_id, name=name, post_count=n) for tag_id, name, n in tags]
+
+
+def load_popular_tags():
+    """Tags with the most posts first, read in the order of
+       the index on (post_count, id)."""
+    tags = db.session.query(Tag.id, Tag.name, Tag.post_count).order_by(Tag.post_count.desc(), Tag.id.desc())
+    return [dict(id=tag_id, name=name, post_count=n) for tag_id, name, n in tags]
+
+
+def load_user_profile(user_id):
+    user = User.query.get(user_id)
+    if user is None:
+        return None
+    return dict(id=user.id, first_name=user.first_name, last_name=user.last_name, image_url=user.image_url)
+
+
+def load_tag(tag_id):
+    tag = db.session.query(Tag.id, Tag.name).filter_by(id=tag_id).first()
+    return tag and dict(id=tag.id, name=tag.name)
+
+
+def tag_posts(tag_id):
+    """The id and title of every post with the tag, read in
+       batches of STREAM_BATCH_SIZE rows from a server-side
+       cursor rather than all at once."""
+    query = (select(Post.id, Post.title)
+             .join(PostTag, PostTag.post_id == Post.id)
+             .where(PostTag.tag_id == tag_id)
+             .order_by(Post.id)
+             .execution_options(yield_per=current_app.config['STREAM_BATCH_SIZE']))
+    yield from db.session.execute(query)
+
+
+def stream_template(template_name, **context):
+    """Renders a template piece by piece, as it is iterated,
+       in chunks of about STREAM_BUFFER_SIZE pieces. Flask 2.2
+       has this built in."""
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_or_select_template(template_name).stream(context)
+    stream.enable_buffering(current_app.config['STREAM_BUFFER_SIZE'])
+    return stream
+
+
+def user_version(user_id):
+    row = (db.session.query(User.updated_at, func.count(Post.id), func.max(Post.updated_at))
+           .outerjoin(Post, Post.user_id == User.id)
+           .filter(User.id == user_id)
+           .group_by(User.id, User.updated_at)
+           .first())
+    return tuple(row) if row else None
+
+
+def post_version(post_id):
+    row = (db.session.query(Post.updated_at, User.updated_at, func.count(Tag.id), func.max(Tag.updated_at))
+           .join(User, User.id == Post.user_id)
+           .outerjoin(PostTag, PostTag.post_id == Post.id)
+           .outerjoin(Tag, Tag.id == PostTag.tag_id)
+           .filter(Post.id == post_id)
+           .group_by(Post.id, Post.updated_at, User.updated_at)
+           .first())
+    return tuple(row) if row else None
+
+
+def tag_version(tag_id):
+    row = (db.session.query(Tag.updated_at, func.count(Post.id), func.max(Post.updated_at))
+           .outerjoin(PostTag, PostTag.tag_id == Tag.id)
+           .outerjoin(Post, Post.id == PostTag.post_id)
+           .filter(Tag.id == tag_id)
+           .group_by(Tag.id, Tag.updated_at)
+           .first())
+    return tuple(row) if row else None
+
+
+def page_version(rows, *cursors):
+    """The validator of a list page, made from the rows it shows
+       (as dicts) and its cursors, with the newest of their
+       updated_at stamps for Last-Modified. Only the page itself
+       is read, never the whole table."""
+    stamps = [value for row in rows for name, value in row.items() if name.endswith('updated_at')]
+    return (tuple(tuple(row.values()) for row in rows),) + cursors + (max(stamps, default=None),)
+
+
+def sync_post_tags(post_id, tag_names, current=None, touch=True):
+    """Makes the tags on a post match `tag_names`.
+
+       The names are resolved to ids with one IN query and compared
+       with the post's current posttags rows, so only the difference
+       is written: one bulk INSERT for new tags and one DELETE for
+       dropped ones. Nothing is committed here; the caller commits
+       the whole change as a single transaction. Pass `current` when
+       the post's tag ids are already known (an empty set for a post
+       that was just created) to skip looking them up. A post whose
+       tags change has its updated_at bumped, so its page's ETag
+       changes too, unless `touch` is false because the caller
+       updates the posts row itself."""
+    wanted = set()
+    if tag_names:
+        wanted = {tag_id for (tag_id,) in db.session.query(Tag.id).filter(Tag.name.in_(set(tag_names)))}
+    if current is None:
+        current = {tag_id for (tag_id,) in db.session.query(PostTag.tag_id).filter_by(post_id=post_id)}
+
+    added = wanted - current
+    removed = current - wanted
+    if not (added or removed):
+        return added, removed
+
+    stale = [('post_page', str(post_id))]
+    stale += [('tag_page', str(tag_id)) for tag_id in added | removed]
+    posttags = PostTag.__table__
+    posts = Post.__table__
+    if added:
+        db.session.execute(posttags.insert().execution_options(invalidates=stale),
+                           [dict(post_id=post_id, tag_id=tag_id) for tag_id in added])
+    if removed:
+        db.session.execute(posttags.delete()
+                           .where(posttags.c.post_id == post_id, posttags.c.tag_id.in_(removed))
+                           .execution_options(invalidates=stale))
+    tags_changed(db.session, added, removed)
+    if touch:
+        db.session.execute(posts.update()
+                           .where(posts.c.id == post_id)
+                           .values(updated_at=datetime.utcnow())
+                           .execution_options(invalidates=stale))
+    return added, removed
+
+
+def versioned_update(model, row_id, version, values, invalidates):
+    """Writes `values` to one User or Post row and bumps its
+       version, in a single UPDATE that sets only those columns.
+       Given the version the edit was made from, the row is only
+       written if it is still at that version (the check the
+       mapper's version_id_col makes for ORM flushes). Returns
+       whether a row was written."""
+    table = model.__table__
+    statement = (table.update()
+                 .where(table.c.id == row_id)
+                 .values(version=table.c.version + 1, **values)
+                 .execution_options(invalidates=invalidates))
+    if version is not None:
+        statement = statement.where(table.c.version == version)
+    return db.session.execute(statement).rowcount == 1
+
+
+def form_version(form):
+    """The version an edit form was made from, or None for a
+       form without one, which skips the check. A version that
+       is not a number is refused with a 400 rather than being
+       taken as missing."""
+    version = form.get('version')
+    if version is None:
+        return None
+    try:
+        return int(version)
+    except ValueError:
+        abort(400)
+
+
+def refuse_stale_edit(model, row_id, form_url):
+    """The response to an edit whose UPDATE wrote nothing: a
+       409 if the row is still there, as someone else saved it
+       first, or the not-found page if it is gone."""
+    db.session.rollback()
+    if db.session.query(model.id).filter_by(id=row_id).scalar() is None:
+        return redirect(url_for('.not_found'))
+    return render_template('conflict.html', form_url=form_url), 409
+
+
+USER_LIST_ORDER = (User.last_name, User.first_name, User.id)
+POST_LIST_ORDER = (Post.created_at, Post.id)
+
+
+def feed_query():
+    """Title-only rows for the feed, with each post's author."""
+    return (select(Post.id, Post.title, Post.created_at, Post.user_id, User.first_name, User.last_name,
+                   Post.updated_at.label('post_updated_at'), User.updated_at.label('user_updated_at'))
+            .join(User, User.id == Post.user_id))
+
+
+def user_posts_query(user_id):
+    """Title-only rows for one user's posts."""
+    return select(Post.id, Post.title, Post.created_at).where(Post.user_id == user_id)
+
+
+def posts_page(query, after, before):
+    """One page of a post listing, newest first. The
+       listings are keyset paginated on (created_at, id),
+       which the posts indexes cover, so every page costs
+       the same as the first."""
+    per_page = current_app.config['POSTS_PER_PAGE']
+    rows = db.session.execute(keyset_filter(query, POST_LIST_ORDER, per_page, after=after, before=before,
+                                            descending=True)).all()
+    rows, next_cursor, prev_cursor = keyset_result(rows, POST_LIST_ORDER, per_page, after=after, before=before)
+    return [row._asdict() for row in rows], next_cursor, prev_cursor
+
+
+@bp.route('/')
 def home():
     """Route used to redirect to the main page
        of all users."""
-    return redirect(url_for('user_list'))
+    return redirect(url_for('.user_list'))
 
 
-@app.route('/users')
+@bp.route('/users')
+@replica_reads
 def user_list():
-    """The main page that displays all registered users."""
-    users = User.query.all()
-    if users:
-        users = [[f'{user.last_name}, {user.first_name}', user.id] for user in users]
-        return render_template('userlist.html', users=users)
-    
-    return render_template('userlist.html')
+    """The main page that displays registered users, one
+       page at a time. Pages are keyset paginated on
+       (last name, first name, id) and only select the
+       columns the template needs."""
+    after = decode_cursor(request.args.get('after'), USER_LIST_ORDER)
+    before = decode_cursor(request.args.get('before'), USER_LIST_ORDER)
+    per_page = current_app.config['USERS_PER_PAGE']
+
+    page = {}
 
+    def version():
+        query = db.session.query(*USER_LIST_ORDER, User.post_count, User.updated_at)
+        rows, page['next'], page['prev'] = keyset_page(query, USER_LIST_ORDER, per_page, after=after, before=before)
+        page['rows'] = [row._asdict() for row in rows]
+        return page_version(page['rows'], page['next'], page['prev'])
 
-@app.route('/users/new', methods=['GET', 'POST'])
+    def render():
+        users = [[f"{row['last_name']}, {row['first_name']}", row['id'], row['post_count']] for row in page['rows']]
+        return render_template('userlist.html', users=users,
+                               next_cursor=page['next'], prev_cursor=page['prev'])
+
+    key = repr((after, before, per_page))
+    return conditional_page(current_cache(), 'users_page', key, version, render)
+
+
+@bp.route('/users/new', methods=['GET', 'POST'])
 def add_user():
     """Adds a user to the db and the user profiles page"""
     if request.method == 'GET':
@@ -58,133 +330,167 @@ def add_user():
     
     db.session.add(user)
     db.session.commit()
-    return redirect(url_for('user_list'))
+    return redirect(url_for('.user_list'))
 
 
-@app.route('/users/<id>')
+@bp.route('/users/<id>')
+@replica_reads
 def show_user(id):
-    """Shows a user's profile."""
-    user = User.query.get(id)
-    if user:
-        posts = user.posts
-        return render_template('userdisplay.html', user=user, posts=posts)
-    return redirect(url_for('not_found'))
+    """Shows a user's profile, read through the cache,
+       with their posts newest first. Only the first page
+       of posts is kept in the page cache."""
+    if not id.isdigit():
+        return redirect(url_for('.not_found'))
+    after = decode_cursor(request.args.get('after'), POST_LIST_ORDER)
+    before = decode_cursor(request.args.get('before'), POST_LIST_ORDER)
+
+    def render():
+        user = current_cache().get_or_load('user', int(id), lambda: load_user_profile(id))
+        posts, next_cursor, prev_cursor = posts_page(user_posts_query(user['id']), after, before)
+        return render_template('userdisplay.html', user=user, posts=posts,
+                               next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+    if after is None and before is None:
+        response = conditional_page(current_cache(), 'user_page', int(id), lambda: user_version(id), render)
+    else:
+        response = User.query.get(id) and render()
+    return response or redirect(url_for('.not_found'))
 
 
-@app.route('/users/<id>/edit', methods=['GET', 'POST'])
+@bp.route('/users/<id>/edit', methods=['GET', 'POST'])
 def edit_profile(id):
-    """Returns a form for a user to edit their profile."""
-    user = User.query.get(id)
-    categories = 'first_name last_name image_url'.split()
-    if user:
-        if request.method == 'GET':
-            return render_template('edit.html', id=user.id)
-    
-        form = request.form
-        for i in range(len(categories)):
-            if form[categories[i]]:
-                if i == 0:
-                    user.first_name = form[categories[i]]
-                elif i == 1:
-                    user.last_name = form[categories[i]]
-                else:
-                    user.image_url = form[categories[i]]
-
-        db.session.add(user)
-        db.session.commit()
-        return redirect(url_for('user_list', id=user.id))
-    else:
-        return redirect(url_for('user_list'))
+    """Returns a form for a user to edit their profile, and
+       saves the fields that were filled in with one UPDATE.
+       The form carries the version of the profile it was
+       made from, so an edit from a form that someone else's
+       save has made stale gets a 409 instead of overwriting."""
+    if request.method == 'GET':
+        user = User.query.get(id)
+        if user is None:
+            return redirect(url_for('.user_list'))
+        return render_template('edit.html', id=user.id, version=user.version)
 
+    form = request.form
+    changes = {name: form[name] for name in ('first_name', 'last_name', 'image_url') if form.get(name)}
+    stale = [('user', str(id)), ('user_page', str(id)), ('users_page', None), ('post_page', None),
+             ('feed_page', None)]
+    if not versioned_update(User, id, form_version(request.form), changes, stale):
+        return refuse_stale_edit(User, id, url_for('.edit_profile', id=id))
+    db.session.commit()
+    return redirect(url_for('.user_list', id=id))
 
-@app.route('/users/<id>/delete')
+
+@bp.route('/users/<id>/delete')
 def delete_user(id):
     """When the delete profile button is clicked, 
        profile deletion is handled via this route,
-       and the user is redirected to the main page."""
-    user = User.query.get(id)
-    if user:
-        for post in user.posts:
-            db.session.delete(post)
-        db.session.delete(user)
-        db.session.commit()
+       and the user is redirected to the main page.
+       A single DELETE is issued; the database cascades
+       it to the user's posts and their posttags rows."""
+    user_deleted(db.session, id)
+    User.query.filter_by(id=id).delete(synchronize_session='fetch')
+    db.session.commit()
     
-    return redirect(url_for('user_list'))
+    return redirect(url_for('.user_list'))
 
 
-@app.route('/users/<id>/posts/new', methods=['GET', 'POST'])
+@bp.route('/users/<id>/posts/new', methods=['GET', 'POST'])
 def add_post(id):
     """Adds a post to the database and links it
-       with a user, IF the user id is valid."""
+       with a user, IF the user id is valid. The post
+       and its tags are written in one transaction, with
+       the new id read back from the INSERT itself."""
     user = User.query.get(id)
     if user:
-        tags = Tag.query.all()
         if request.method == 'GET':
-            return render_template('add_post.html', user=user, tags=tags)
+            return render_template('add_post.html', user=user, tags=current_cache().get_or_load('tags', 'all', load_all_tags))
         
         form = request.form
         post = Post(title=form['title'], content=form['content'], created_at=datetime.now(), user_id=id)
         db.session.add(post)
+        db.session.flush()
+        post_added(db.session, user.id)
+        sync_post_tags(post.id, form.getlist('tag'), current=set())
         db.session.commit()
-        post = Post.query.all()[-1]
-        filter_tags_and_save(tags, post.id, form.getlist('tag'))
-        return redirect(url_for('show_user', id=id))
+        return redirect(url_for('.show_user', id=id))
     
-    return redirect(url_for('not_found'))
+    return redirect(url_for('.not_found'))
+
+
+@bp.route('/posts')
+@replica_reads
+def feed():
+    """The most recent posts by everyone, newest first."""
+    after = decode_cursor(request.args.get('after'), POST_LIST_ORDER)
+    before = decode_cursor(request.args.get('before'), POST_LIST_ORDER)
 
+    page = {}
 
-@app.route('/posts/<postid>')
+    def version():
+        page['posts'], page['next'], page['prev'] = posts_page(feed_query(), after, before)
+        return page_version(page['posts'], page['next'], page['prev'])
+
+    def render():
+        return render_template('feed.html', posts=page['posts'], next_cursor=page['next'], prev_cursor=page['prev'])
+
+    key = repr((after, before))
+    return conditional_page(current_cache(), 'feed_page', key, version, render)
+
+
+@bp.route('/posts/<postid>')
+@replica_reads
 def show_post(postid):
     """When a post link is clicked, this link handles
        routing the user to the post."""
-    post = Post.query.get(postid)
-    if post:
-        tags = post.tags
-        return render_template('show_post.html', post=post, tags=tags)
-    return redirect(url_for('not_found'))
+    def render():
+        post = Post.query.options(joinedload(Post.users), selectinload(Post.tags)).get(postid)
+        return render_template('show_post.html', post=post, tags=post.tags)
 
+    response = postid.isdigit() and conditional_page(current_cache(), 'post_page', int(postid),
+                                                     lambda: post_version(postid), render)
+    return response or redirect(url_for('.not_found'))
 
-@app.route('/posts/<postid>/edit', methods=['GET', 'POST'])
+
+@bp.route('/posts/<postid>/edit', methods=['GET', 'POST'])
 def edit_post(postid):
     """Allows a user to edit a post and change either
-       the title, content, or both."""
-    post = Post.query.get(postid)
-    if post:
-        tags = Tag.query.all()
-        if request.method == 'GET':
-            return render_template('edit_post.html', post=post, tags=tags)
-        
-        form = request.form
-        categories = 'title content'.split()
-        for i in range(len(categories)):
-            if i == 0 and form['title']:
-                post.title = form['title']
-            else:
-                if form['content']:
-                    post.content = form['content']
+       the title, content, or both, and its tags. Like
+       profile edits, the change is one versioned UPDATE
+       and a stale form gets a 409."""
+    if request.method == 'GET':
+        post = Post.query.get(postid)
+        if post is None:
+            return redirect(url_for('.not_found'))
+        return render_template('edit_post.html', post=post, tags=current_cache().get_or_load('tags', 'all', load_all_tags),
+                               checked={tag.id for tag in post.tags})
 
-        db.session.add(post)
-        db.session.commit()
-        filter_tags_and_save(tags, post.id, form.getlist('tag'))
-        return redirect(url_for('show_post', postid=post.id))
-    return redirect(url_for('not_found'))
+    form = request.form
+    changes = {name: form[name] for name in ('title', 'content') if form.get(name)}
+    stale = [('post_page', str(postid)), ('user_page', None), ('tag_page', None),
+             ('feed_page', None)]
+    if not versioned_update(Post, postid, form_version(request.form), changes, stale):
+        return refuse_stale_edit(Post, postid, url_for('.edit_post', postid=postid))
+    sync_post_tags(int(postid), form.getlist('tag'), touch=False)
+    db.session.commit()
+    return redirect(url_for('.show_post', postid=postid))
 
 
-@app.route('/posts/<postid>/delete')
+@bp.route('/posts/<postid>/delete')
 def delete_post(postid):
     """Similar to the delete user route, this handles
        deletion of a post from the database, and thus
        the UI."""
-    post = Post.query.get(postid)
-    user_id = post.users.id
-    if post:
-        db.session.delete(post)
-        db.session.commit()
-    
-    return redirect(url_for('show_user', id=user_id))
+    user_id = db.session.query(Post.user_id).filter_by(id=postid).scalar()
+    if user_id is None:
+        return redirect(url_for('.not_found'))
 
+    post_deleted(db.session, int(postid), user_id)
+    Post.query.filter_by(id=postid).delete(synchronize_session='fetch')
+    db.session.commit()
+    return redirect(url_for('.show_user', id=user_id))
 
-@app.route('/tags/new', methods=['GET', 'POST'])
+
+@bp.route('/tags/new', methods=['GET', 'POST'])
 def add_tag():
     if request.method == 'GET':
         return render_template('add_tags.html')
@@ -193,24 +499,46 @@ def add_tag():
     new_tag = Tag(name=form['newtag'])
     db.session.add(new_tag)
     db.session.commit()
-    return redirect(url_for('show_tags'))
+    return redirect(url_for('.show_tags'))
 
 
-@app.route('/tags')
+@bp.route('/tags')
+@replica_reads
 def show_tags():
-    all_tags = Tag.query.all()
-    return render_template('show_tags.html', tags=all_tags)
+    """Lists every tag with its post count, by id or, with
+       ?sort=popular, by number of posts."""
+    sort = 'popular' if request.args.get('sort') == 'popular' else 'all'
+    loader = load_popular_tags if sort == 'popular' else load_all_tags
+
+    tags = []
+
+    def version():
+        tags[:] = current_cache().get_or_load('tags', sort, loader)
+        return page_version(tags)
+
+    def render():
+        return render_template('show_tags.html', tags=tags, sort=sort)
 
+    return conditional_page(current_cache(), 'tags_page', sort, version, render)
 
-@app.route('/tags/<tag_id>')
+
+@bp.route('/tags/<tag_id>')
+@replica_reads
 def get_tag_by_id(tag_id):
-    tag = Tag.query.get(tag_id)
-    if tag:
-        return render_template('one_tag.html', tag=tag)
-    return redirect(url_for('not_found'))
+    """A tag and every post that has it. A tag can be on any
+       number of posts, so the page is streamed: posts are read
+       from a cursor and sent as they are rendered, instead of
+       the whole list and page being built in memory first."""
+    def generate():
+        tag = current_cache().get_or_load('tag', int(tag_id), lambda: load_tag(tag_id))
+        return stream_template('one_tag.html', tag=dict(tag, posts=tag_posts(tag['id'])))
+
+    response = tag_id.isdigit() and streamed_page(current_cache(), 'tag_page', int(tag_id), lambda: tag_version(tag_id),
+                                                  generate, current_app.config['STREAMED_PAGE_CACHE_BYTES'])
+    return response or redirect(url_for('.not_found'))
 
 
-@app.route('/tags/<tag_id>/edit', methods=['GET', 'POST'])
+@bp.route('/tags/<tag_id>/edit', methods=['GET', 'POST'])
 def edit_tags(tag_id):
     tag = Tag.query.get(tag_id)
     if tag:
@@ -222,27 +550,157 @@ def edit_tags(tag_id):
         tag.name = new_tag_name
         db.session.add(tag)
         db.session.commit()
-        return redirect(url_for('get_tag_by_id', tag_id=tag.id))
+        return redirect(url_for('.get_tag_by_id', tag_id=tag.id))
 
 
-@app.route('/tags/<tag_id>/delete')
+@bp.route('/tags/<tag_id>/delete')
 def delete_tag(tag_id):
     """Similar to the delete user route, this handles
        deletion of a tag from the database, and thus
-       the UI."""
-    tag = Tag.query.get(tag_id)
-    if tag:
-        for posttag in tag.join_tags:
-            db.session.delete(posttag)
-        db.session.delete(tag)
-        db.session.commit()
+       the UI. The database cascades the DELETE to
+       the tag's posttags rows."""
+    Tag.query.filter_by(id=tag_id).delete(synchronize_session='fetch')
+    db.session.commit()
     
-    return redirect(url_for('show_tags'))
-
-
-@app.route('/404')
+    return redirect(url_for('.show_tags'))
+
+
+@bp.route('/search')
+@replica_reads
+def search():
+    """Full-text search over post titles and content,
+       best matches first, one page of results at a time."""
+    terms = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+    page = max(page, 1)
+    try:
+        results, has_next = search_posts(db.session, terms, page, current_app.config['SEARCH_RESULTS_PER_PAGE'])
+    except SearchUnavailable as exc:
+        current_app.logger.warning('search: %s', exc)
+        return render_template('search.html', terms=terms, results=[], page=1, has_next=False,
+                               unavailable=True), 501
+    return render_template('search.html', terms=terms, results=results, page=page, has_next=has_next)
+
+
+@bp.route('/metrics')
+def metrics():
+    """Operational metrics in Prometheus text format."""
+    return Response(render_metrics(current_app), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+DEFAULT_AVATAR = 'img/default-avatar.svg'
+
+
+@bp.app_template_global()
+def avatar_url(user):
+    """The link to a user's avatar. It changes with the
+       image URL, so browsers may cache it for good."""
+    return url_for('.avatar', user_id=user['id'], v=avatar_version(user['image_url']))
+
+
+@bp.route('/avatars/<int:user_id>')
+@replica_reads
+def avatar(user_id):
+    """A user's picture, as a thumbnail served from the
+       on-disk avatar cache. Users with no picture of their
+       own, or whose picture cannot be fetched, get the
+       bundled default. Files go out through send_file, which
+       hands them to the server's sendfile support (or to the
+       front end, with USE_X_SENDFILE on)."""
+    user = current_cache().get_or_load('user', user_id, lambda: load_user_profile(user_id))
+    source = user and user['image_url']
+    if source and source != DEFAULT_IMAGE_URL:
+        try:
+            path = current_app.extensions['blogly_avatars'].path_for(source)
+        except AvatarError as exc:
+            current_app.logger.warning('avatar for user %s: %s', user_id, exc)
+        else:
+            response = send_file(path, max_age=current_app.config['AVATAR_MAX_AGE'])
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+            return response
+    return send_from_directory(current_app.static_folder, DEFAULT_AVATAR, max_age=3600)
+
+
+@bp.route('/404')
 def not_found():
     """A catch all page that is used when the user types
        in a bad route. It automatically redirects after 
        three seconds."""
-    return render_template('404.html')
\ No newline at end of file
+    return render_template('404.html')
+
+
+def create_app(test_config=None):
+    """Builds the app. Settings come from the environment (or
+       .env), with `test_config` applied on top.
+
+       Nothing here touches the database: Flask-SQLAlchemy opens
+       the engine on first use, so a pre-fork server can import
+       and fork the app without holding connections, and start-up
+       does not depend on the schema or the database's latency.
+       Tables are created with 'flask blogly init-db'."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['USERS_PER_PAGE'] = config('USERS_PER_PAGE', default=50, cast=int)
+    app.config['QUERY_COUNTER'] = config('QUERY_COUNTER', default=False, cast=bool)
+    app.config['CACHE_BACKEND'] = config('CACHE_BACKEND', default='local')
+    app.config['CACHE_URL'] = config('CACHE_URL', default='localhost:11211')
+    app.config['CACHE_MAXSIZE'] = config('CACHE_MAXSIZE', default=1024, cast=int)
+    app.config['CACHE_TTL'] = config('CACHE_TTL', default=300, cast=int)
+    app.config['WEB_CONCURRENCY'] = config('WEB_CONCURRENCY', default=1, cast=int)
+    app.config['SEARCH_RESULTS_PER_PAGE'] = config('SEARCH_RESULTS_PER_PAGE', default=20, cast=int)
+    app.config['POSTS_PER_PAGE'] = config('POSTS_PER_PAGE', default=20, cast=int)
+    app.config['REQUEST_METRICS'] = config('REQUEST_METRICS', default=True, cast=bool)
+    app.config['PROFILING_ENABLED'] = config('PROFILING_ENABLED', default=False, cast=bool)
+    app.config['PROFILE_DIR'] = config('PROFILE_DIR', default=os.path.join(app.instance_path, 'profiles'))
+    app.config['AVATAR_CACHE_DIR'] = config('AVATAR_CACHE_DIR', default=os.path.join(app.static_folder, 'img', 'avatars'))
+    app.config['AVATAR_SIZE'] = config('AVATAR_SIZE', default=128, cast=int)
+    app.config['AVATAR_MAX_AGE'] = config('AVATAR_MAX_AGE', default=365 * 24 * 3600, cast=int)
+    app.config['AVATAR_FETCH_TIMEOUT'] = config('AVATAR_FETCH_TIMEOUT', default=5, cast=float)
+    app.config['AVATAR_ALLOWED_HOSTS'] = config('AVATAR_ALLOWED_HOSTS', default='', cast=Csv())
+    app.config['AVATAR_RETRY_AFTER'] = config('AVATAR_RETRY_AFTER', default=3600, cast=int)
+    app.config['USE_X_SENDFILE'] = config('USE_X_SENDFILE', default=False, cast=bool)
+    app.config['SQLALCHEMY_REPLICA_URI'] = config('SQLALCHEMY_REPLICA_URI', default='')
+    app.config['REPLICA_STICKY_SECONDS'] = config('REPLICA_STICKY_SECONDS', default=5, cast=int)
+    app.config['STREAM_BATCH_SIZE'] = config('STREAM_BATCH_SIZE', default=500, cast=int)
+    app.config['STREAM_BUFFER_SIZE'] = config('STREAM_BUFFER_SIZE', default=64, cast=int)
+    app.config['STREAMED_PAGE_CACHE_BYTES'] = config('STREAMED_PAGE_CACHE_BYTES', default=256 * 1024, cast=int)
+    app.config['JINJA_BYTECODE_CACHE_DIR'] = config('JINJA_BYTECODE_CACHE_DIR',
+                                                    default=os.path.join(app.instance_path, 'template-cache'))
+    app.config.update(test_config or {})
+    if app.config['SQLALCHEMY_REPLICA_URI']:
+        app.config.setdefault('SQLALCHEMY_BINDS', {})['replica'] = app.config['SQLALCHEMY_REPLICA_URI']
+    if 'SQLALCHEMY_DATABASE_URI' not in app.config:
+        app.config['SQLALCHEMY_DATABASE_URI'] = config('SQLALCHEMY_DATABASE_URI')
+    if 'SQLALCHEMY_ENGINE_OPTIONS' not in app.config:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = pool_options(
+            app.config['SQLALCHEMY_DATABASE_URI'],
+            size=config('DB_POOL_SIZE', default=5, cast=int),
+            max_overflow=config('DB_MAX_OVERFLOW', default=10, cast=int),
+            timeout=config('DB_POOL_TIMEOUT', default=30, cast=int),
+            recycle=config('DB_POOL_RECYCLE', default=1800, cast=int),
+            pre_ping=config('DB_POOL_PRE_PING', default=True, cast=bool),
+        )
+
+    connect_db(app)
+    init_replica_routing(app, db)
+    init_query_counter(app)
+    init_request_metrics(app)
+    # Misses are loaded from the primary: what a lagging replica
+    # returned would be served from the cache to clients that are
+    # meant to read their own writes.
+    app.extensions['blogly_cache'] = cache = Cache(make_cache_backend(app.config),
+                                                   load_context=lambda: primary_reads(db.session))
+    register_metrics(app, cache.metrics)
+    register_metrics(app, lambda: pool_metrics(db.engine.pool))
+    if app.config['JINJA_BYTECODE_CACHE_DIR']:
+        os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], mode=0o700, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_BYTECODE_CACHE_DIR'])
+    app.extensions['blogly_avatars'] = AvatarStore(app.config['AVATAR_CACHE_DIR'], size=app.config['AVATAR_SIZE'],
+                                                   timeout=app.config['AVATAR_FETCH_TIMEOUT'],
+                                                   allowed_hosts=frozenset(app.config['AVATAR_ALLOWED_HOSTS']),
+                                                   retry_after=app.config['AVATAR_RETRY_AFTER'])
+    app.register_blueprint(bp)
+    app.cli.add_command(blogly)
+    return app
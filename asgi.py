@@ -0,0 +1,240 @@
+"""ASGI entry point for serving Blogly from an event loop.
+
+The read-only pages (user_list, feed, show_user, show_post, show_tags
+and get_tag_by_id) run as coroutines on SQLAlchemy's AsyncSession, so a
+request waiting on the database does not hold a worker thread. They
+render the same templates with the same context as the Flask views,
+so the HTML is identical. Every other request is handed to the Flask
+app itself on a thread pool.
+
+Needs an ASGI server and an async database driver (asyncpg for
+Postgres, aiosqlite for SQLite), neither of which the sync app uses:
+
+    pip install uvicorn asyncpg aiosqlite
+    uvicorn asgi_app:application
+
+asgi_app.py holds the instance; importing this module builds nothing.
+"""
+import asyncio
+import io
+import sys
+from urllib.parse import parse_qsl
+
+from flask import current_app, render_template
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import joinedload, selectinload, sessionmaker
+from werkzeug.exceptions import HTTPException
+
+from app import feed_query, user_posts_query, POST_LIST_ORDER, USER_LIST_ORDER
+from models import User, Post, Tag, PostTag
+from pagination import decode_cursor, keyset_filter, keyset_result
+
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+
+def async_database_url(uri):
+    """The async-driver flavour of a database URI."""
+    url = make_url(uri)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+def render(path, template, **context):
+    """Renders a template exactly as the Flask view would."""
+    with current_app.test_request_context(path):
+        return render_template(template, **context)
+
+
+async def user_list(session, path, args):
+    after = decode_cursor(args.get('after'), USER_LIST_ORDER)
+    before = decode_cursor(args.get('before'), USER_LIST_ORDER)
+    per_page = current_app.config['USERS_PER_PAGE']
+    query = keyset_filter(select(*USER_LIST_ORDER, User.post_count), USER_LIST_ORDER, per_page,
+                          after=after, before=before)
+    rows = (await session.execute(query)).all()
+    rows, next_cursor, prev_cursor = keyset_result(rows, USER_LIST_ORDER, per_page, after=after, before=before)
+    users = [[f'{row.last_name}, {row.first_name}', row.id, row.post_count] for row in rows]
+    return render(path, 'userlist.html', users=users, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+async def posts_page(session, query, args):
+    after = decode_cursor(args.get('after'), POST_LIST_ORDER)
+    before = decode_cursor(args.get('before'), POST_LIST_ORDER)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    query = keyset_filter(query, POST_LIST_ORDER, per_page, after=after, before=before, descending=True)
+    rows = (await session.execute(query)).all()
+    rows, next_cursor, prev_cursor = keyset_result(rows, POST_LIST_ORDER, per_page, after=after, before=before)
+    return [row._asdict() for row in rows], next_cursor, prev_cursor
+
+
+async def feed(session, path, args):
+    posts, next_cursor, prev_cursor = await posts_page(session, feed_query(), args)
+    return render(path, 'feed.html', posts=posts, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+async def show_user(session, path, args, id):
+    user = await session.get(User, int(id)) if id.isdigit() else None
+    if user is None:
+        return None
+    profile = dict(id=user.id, first_name=user.first_name, last_name=user.last_name, image_url=user.image_url)
+    posts, next_cursor, prev_cursor = await posts_page(session, user_posts_query(user.id), args)
+    return render(path, 'userdisplay.html', user=profile, posts=posts,
+                  next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+async def show_post(session, path, args, postid):
+    if not postid.isdigit():
+        return None
+    query = select(Post).options(joinedload(Post.users), selectinload(Post.tags)).filter_by(id=int(postid))
+    post = (await session.execute(query)).scalar()
+    if post is None:
+        return None
+    return render(path, 'show_post.html', post=post, tags=post.tags)
+
+
+async def show_tags(session, path, args):
+    sort = 'popular' if args.get('sort') == 'popular' else 'all'
+    order = (Tag.post_count.desc(), Tag.id.desc()) if sort == 'popular' else (Tag.id,)
+    tags = await session.execute(select(Tag.id, Tag.name, Tag.post_count).order_by(*order))
+    return render(path, 'show_tags.html', sort=sort,
+                  tags=[dict(id=tag_id, name=name, post_count=n) for tag_id, name, n in tags])
+
+
+async def get_tag_by_id(session, path, args, tag_id):
+    tag = await session.get(Tag, int(tag_id)) if tag_id.isdigit() else None
+    if tag is None:
+        return None
+    posts = await session.execute(select(Post.id, Post.title)
+                                  .join(PostTag, PostTag.post_id == Post.id)
+                                  .filter(PostTag.tag_id == tag.id)
+                                  .order_by(Post.id))
+    page = dict(id=tag.id, name=tag.name, posts=[dict(id=post_id, title=title) for post_id, title in posts])
+    return render(path, 'one_tag.html', tag=page)
+
+
+ASYNC_VIEWS = {
+    'blogly.user_list': user_list,
+    'blogly.feed': feed,
+    'blogly.show_user': show_user,
+    'blogly.show_post': show_post,
+    'blogly.show_tags': show_tags,
+    'blogly.get_tag_by_id': get_tag_by_id,
+}
+
+
+def wsgi_environ(scope, body):
+    """The WSGI environ for an ASGI http scope."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class BloglyASGI:
+    """The ASGI application: async views for the read routes,
+       the Flask app on a thread pool for everything else."""
+
+    def __init__(self, flask_app, database_uri=None):
+        self.flask_app = flask_app
+        self.engine = create_async_engine(async_database_url(database_uri
+                                                             or flask_app.config['SQLALCHEMY_DATABASE_URI']))
+        self.sessions = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.urls = flask_app.url_map.bind('localhost')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        view = None
+        if scope['method'] in ('GET', 'HEAD'):
+            try:
+                endpoint, view_args = self.urls.match(scope['path'], method='GET')
+                view = ASYNC_VIEWS.get(endpoint)
+            except HTTPException:
+                pass
+        if view is None:
+            await self.call_flask(scope, receive, send)
+            return
+
+        path = scope['path']
+        if scope['query_string']:
+            path = f"{path}?{scope['query_string'].decode('latin-1')}"
+        args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+        async with self.sessions() as session:
+            with self.flask_app.app_context():
+                html = await view(session, path, args, **view_args)
+
+        if html is None:
+            await self.respond(send, scope, 302, b'', [(b'location', b'/404')])
+        else:
+            await self.respond(send, scope, 200, html.encode('utf-8'),
+                               [(b'content-type', b'text/html; charset=utf-8')])
+
+    async def respond(self, send, scope, status, body, headers):
+        headers = headers + [(b'content-length', str(len(body)).encode('latin-1'))]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else body})
+
+    async def call_flask(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            body.extend(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        def run():
+            started = {}
+
+            def start_response(status, headers, exc_info=None):
+                started['status'], started['headers'] = status, headers
+
+            result = self.flask_app(wsgi_environ(scope, bytes(body)), start_response)
+            try:
+                return started, b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        started, payload = await asyncio.get_running_loop().run_in_executor(None, run)
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in started['headers']]
+        await send({'type': 'http.response.start', 'status': int(started['status'].split()[0]), 'headers': headers})
+        await send({'type': 'http.response.body', 'body': payload})
+
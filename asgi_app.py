@@ -0,0 +1,15 @@
+"""ASGI entry point for Blogly.
+
+    uvicorn asgi_app:application
+
+Importing this module builds the app, reading its settings from the
+environment as wsgi.py does. ASYNC_DATABASE_URI overrides the async
+flavour of SQLALCHEMY_DATABASE_URI that the async views use.
+"""
+from decouple import config
+
+from app import create_app
+from asgi import BloglyASGI
+
+
+application = BloglyASGI(create_app(), config('ASYNC_DATABASE_URI', default='') or None)
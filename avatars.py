@@ -0,0 +1,226 @@
+import hashlib
+import http.client
+import io
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from functools import partial
+from urllib.parse import urlsplit
+
+
+logger = logging.getLogger('blogly.avatars')
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/gif': '.gif', 'image/webp': '.webp'}
+
+
+class AvatarError(Exception):
+    """The source image could not be fetched or used."""
+
+
+def avatar_version(image_url):
+    """A short fingerprint of the source URL. Avatar links carry
+       it, so a changed image gets a new URL instead of waiting
+       out the long max-age of the old one."""
+    return hashlib.sha1((image_url or '').encode()).hexdigest()[:10]
+
+
+def connect_public(address, timeout, source_address=None, allowed_hosts=()):
+    """Opens a TCP connection like socket.create_connection, but
+       only to public addresses, unless the host is one of
+       `allowed_hosts`. The name is resolved once and the checked
+       address is the one connected to, so a DNS answer that
+       changes in between cannot point the fetch elsewhere."""
+    host, port = address
+    if host in allowed_hosts:
+        return socket.create_connection(address, timeout, source_address)
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    for *_, sockaddr in infos:
+        if not ipaddress.ip_address(sockaddr[0].split('%')[0]).is_global:
+            raise AvatarError(f'{host} resolves to {sockaddr[0]}, which is not a public address')
+    error = OSError(f'could not resolve {host}')
+    for family, kind, proto, _, sockaddr in infos:
+        sock = socket.socket(family, kind, proto)
+        try:
+            sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as exc:
+            sock.close()
+            error = exc
+    raise error
+
+
+def public_connection(connection_class, allowed_hosts, *args, **kwargs):
+    """An http.client connection that connects through connect_public."""
+    connection = connection_class(*args, **kwargs)
+    connection._create_connection = partial(connect_public, allowed_hosts=allowed_hosts)
+    return connection
+
+
+class PublicHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, allowed_hosts):
+        super().__init__()
+        self.allowed_hosts = allowed_hosts
+
+    def http_open(self, req):
+        return self.do_open(partial(public_connection, http.client.HTTPConnection, self.allowed_hosts), req)
+
+
+class PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, allowed_hosts):
+        super().__init__()
+        self.allowed_hosts = allowed_hosts
+
+    def https_open(self, req):
+        return self.do_open(partial(public_connection, http.client.HTTPSConnection, self.allowed_hosts), req)
+
+
+class HTTPOnlyRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urlsplit(newurl).scheme not in ('http', 'https'):
+            raise AvatarError(f'{req.full_url} redirects to {newurl!r}, not an http(s) URL')
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch_image(url, timeout=5, max_bytes=5 * 2 ** 20, allowed_hosts=()):
+    """Downloads an image over http(s). Returns (bytes, content type).
+
+       Only public addresses are fetched from, the targets of
+       redirects included, so a user's image URL cannot reach
+       the server's own network; hosts in `allowed_hosts` are
+       trusted whatever they resolve to. Proxy settings from
+       the environment are ignored for the same reason."""
+    if urlsplit(url).scheme not in ('http', 'https'):
+        raise AvatarError(f'not an http(s) URL: {url!r}')
+    opener = urllib.request.OpenerDirector()
+    for handler in (PublicHTTPHandler(allowed_hosts), PublicHTTPSHandler(allowed_hosts), HTTPOnlyRedirectHandler(),
+                    urllib.request.HTTPDefaultErrorHandler(), urllib.request.HTTPErrorProcessor()):
+        opener.add_handler(handler)
+    request = urllib.request.Request(url, headers={'User-Agent': 'Blogly avatar fetcher'})
+    try:
+        with opener.open(request, timeout=timeout) as response:
+            content_type = response.headers.get_content_type()
+            data = response.read(max_bytes + 1)
+    except (urllib.error.URLError, http.client.HTTPException, OSError, ValueError) as exc:
+        raise AvatarError(f'could not fetch {url}: {exc}') from exc
+    if content_type not in EXTENSIONS:
+        raise AvatarError(f'{url} is {content_type}, not a supported image type')
+    if len(data) > max_bytes:
+        raise AvatarError(f'{url} is larger than {max_bytes} bytes')
+    return data, content_type
+
+
+def make_thumbnail(data, content_type, size):
+    """Scales the image to fit a size x size box, as a PNG, when
+       Pillow is installed. Without it the original is kept."""
+    if Image is None:
+        return data, EXTENSIONS[content_type]
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            out = io.BytesIO()
+            image.save(out, format='PNG', optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise AvatarError(f'not a readable image: {exc}') from exc
+    return out.getvalue(), '.png'
+
+
+def write_atomically(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class AvatarStore:
+    """Thumbnails of remote avatars, cached on disk.
+
+       A thumbnail is stored under the SHA-256 of its own bytes, so
+       the same picture linked from several URLs is kept once. A
+       small pointer file, named after the source URL and size,
+       records which thumbnail a URL produced, or that fetching it
+       failed; a failed source is not tried again for `retry_after`
+       seconds. A source is fetched only when it has no pointer yet,
+       and only by one thread at a time."""
+
+    FAILED = '-'
+
+    def __init__(self, directory, size=128, timeout=5, max_bytes=5 * 2 ** 20, allowed_hosts=(),
+                 retry_after=3600, lock_stripes=64):
+        self.directory = directory
+        self.size = size
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.allowed_hosts = allowed_hosts
+        self.retry_after = retry_after
+        self._locks = [threading.Lock() for _ in range(lock_stripes)]
+
+    def _pointer(self, url):
+        key = hashlib.sha256(f'{self.size}:{url}'.encode()).hexdigest()
+        return os.path.join(self.directory, 'sources', key)
+
+    def _lock_for(self, pointer):
+        # A fixed set of locks shared out by hash, so the set does
+        # not grow with the number of URLs ever seen.
+        return self._locks[int(os.path.basename(pointer)[:8], 16) % len(self._locks)]
+
+    def cached(self, url):
+        """The thumbnail path for `url`, or None if it has none yet.
+           Raises AvatarError if fetching it failed recently."""
+        pointer = self._pointer(url)
+        try:
+            with open(pointer) as file:
+                name = file.read().strip()
+        except FileNotFoundError:
+            return None
+        if name.startswith(self.FAILED):
+            if time.time() - os.path.getmtime(pointer) < self.retry_after:
+                raise AvatarError(f'{url} failed recently: {name[1:]}')
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.exists(path) else None
+
+    def path_for(self, url):
+        """The thumbnail path for `url`, fetching it if need be.
+           Raises AvatarError if the source is unusable."""
+        path = self.cached(url)
+        if path is not None:
+            return path
+        pointer = self._pointer(url)
+        with self._lock_for(pointer):
+            path = self.cached(url)
+            if path is not None:
+                return path
+            os.makedirs(os.path.dirname(pointer), exist_ok=True)
+            try:
+                data, content_type = fetch_image(url, self.timeout, self.max_bytes, self.allowed_hosts)
+                thumbnail, extension = make_thumbnail(data, content_type, self.size)
+            except AvatarError as exc:
+                write_atomically(pointer, f'{self.FAILED}{exc}'.encode())
+                raise
+            name = hashlib.sha256(thumbnail).hexdigest() + extension
+            path = os.path.join(self.directory, name)
+            if not os.path.exists(path):
+                write_atomically(path, thumbnail)
+            write_atomically(pointer, name.encode())
+            logger.info('cached avatar %s as %s', url, name)
+            return path
@@ -0,0 +1,133 @@
+"""Latency under concurrency: the sync app against the ASGI app.
+
+Serves the app twice on local ports, first with werkzeug's threaded
+server and then with uvicorn running asgi_app:application, and drives the
+read pages with --concurrency clients. The application cache is off,
+so every request reaches the database. Reports throughput and p50/p99
+latency for each. The difference shows most against a database with
+real network latency:
+
+    python -m benchmarks.bench_async --concurrency 8,32,128
+    python -m benchmarks.bench_async --db postgresql:///blogly_bench
+
+Needs uvicorn and the async driver for the database (aiosqlite or
+asyncpg).
+"""
+import os
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+from benchmarks.common import bench_app, parser, serve_wsgi
+
+
+def seed(app, users, posts_per_user):
+    from models import db, User, Post, Tag
+
+    with app.app_context():
+        tags = [Tag(name=f'tag{n}') for n in range(10)]
+        db.session.add_all(tags)
+        for n in range(users):
+            user = User(first_name=f'First{n}', last_name=f'Last{n}')
+            user.posts = [Post(title=f'Post {n}.{m}', content='Lorem ipsum ' * 20, created_at=datetime.now(),
+                               tags=tags[m % 3:m % 3 + 3]) for m in range(posts_per_user)]
+            db.session.add(user)
+        db.session.commit()
+        user_ids = [user_id for user_id, in db.session.query(User.id)]
+        post_ids = [post_id for post_id, in db.session.query(Post.id)]
+        tag_ids = [tag.id for tag in tags]
+    return (['/users', '/tags'] + [f'/users/{n}' for n in user_ids]
+            + [f'/posts/{n}' for n in post_ids] + [f'/tags/{n}' for n in tag_ids])
+
+
+def load(base, paths, concurrency, total):
+    """Fetches `total` pages with `concurrency` clients and
+       returns (seconds, latencies, errors)."""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def client():
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(base + paths[n % len(paths)]) as response:
+                    response.read()
+            except (urllib.error.URLError, ConnectionError):
+                errors.append(n)
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, errors
+
+
+def wait_for(base):
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base + '/tags').read()
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    raise RuntimeError(f'server at {base} did not come up')
+
+
+def serve_async(app, port):
+    import uvicorn
+    from asgi import BloglyASGI
+
+    server = uvicorn.Server(uvicorn.Config(BloglyASGI(app), host='127.0.0.1', port=port,
+                                           log_level='warning', access_log=False))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return stop
+
+
+def main():
+    ap = parser(__doc__)
+    ap.add_argument('--concurrency', default='8,32,128', help='comma separated client counts to try')
+    ap.add_argument('--requests', type=int, default=2000, help='requests per run')
+    ap.add_argument('--users', type=int, default=200)
+    ap.add_argument('--posts', type=int, default=5, help='posts per user')
+    ap.add_argument('--port', type=int, default=8931)
+    args = ap.parse_args()
+
+    os.environ['CACHE_MAXSIZE'] = '0'
+    app = bench_app(args.db)
+    paths = seed(app, args.users, args.posts)
+
+    print(f'{"server":>8} {"clients":>8} {"req/s":>9} {"p50 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for name, serve in [('sync', serve_wsgi), ('async', serve_async)]:
+        stop = serve(app, args.port)
+        base = f'http://127.0.0.1:{args.port}'
+        try:
+            wait_for(base)
+            for concurrency in [int(n) for n in args.concurrency.split(',')]:
+                elapsed, latencies, errors = load(base, paths, concurrency, args.requests)
+                cuts = statistics.quantiles(latencies, n=100)
+                print(f'{name:>8} {concurrency:>8} {len(latencies) / elapsed:>9.1f} '
+                      f'{cuts[49] * 1000:>8.1f} {cuts[98] * 1000:>8.1f} {len(errors):>7}')
+        finally:
+            stop()
+        args.port += 1
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Deleting a prolific user: ORM iteration versus a cascading DELETE.
+
+Seeds users with --posts posts each (every post tagged) and deletes
+them both ways: the old delete_user loop, which loads every post and
+deletes it through the session, and the single DELETE the route issues
+now, which leaves the posts and posttags rows to ON DELETE CASCADE.
+
+    python -m benchmarks.bench_cascade_delete --posts 10000
+"""
+import time
+from datetime import datetime
+
+from benchmarks.common import StatementCounter, bench_app, parser
+
+
+def main():
+    ap = parser(__doc__)
+    ap.add_argument('--posts', type=int, default=10000, help='posts owned by each deleted user')
+    args = ap.parse_args()
+
+    app = bench_app(args.db)
+    from models import db, User, Post, Tag, PostTag
+
+    with app.app_context():
+        tag = Tag(name='bench')
+        db.session.add(tag)
+        db.session.commit()
+        tag_id = tag.id
+
+        def seed():
+            user = User(first_name='Prolific', last_name='Writer')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+            now = datetime.now()
+            db.session.execute(Post.__table__.insert(), [
+                dict(title=f'post {i}', content='x' * 200, created_at=now, user_id=user_id)
+                for i in range(args.posts)
+            ])
+            post_ids = [post_id for (post_id,) in db.session.query(Post.id).filter_by(user_id=user_id)]
+            db.session.execute(PostTag.__table__.insert(), [
+                dict(post_id=post_id, tag_id=tag_id) for post_id in post_ids
+            ])
+            db.session.commit()
+            db.session.expunge_all()
+            return user_id
+
+        def orm_iteration(user_id):
+            user = User.query.get(user_id)
+            for post in user.posts:
+                db.session.delete(post)
+            db.session.delete(user)
+            db.session.commit()
+
+        def cascading_delete(user_id):
+            User.query.filter_by(id=user_id).delete(synchronize_session='fetch')
+            db.session.commit()
+
+        for label, delete in [('ORM iteration', orm_iteration), ('cascading DELETE', cascading_delete)]:
+            user_id = seed()
+            counter = StatementCounter()
+            start = time.perf_counter()
+            with counter.watch(db.engine):
+                delete(user_id)
+            elapsed = time.perf_counter() - start
+            left = Post.query.filter_by(user_id=user_id).count()
+            print(f'{label:>16}: {elapsed:8.3f}s, {counter.statements} statements, {left} posts left')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Bulk import and export throughput.
+
+Writes a JSON Lines file of --users users, --tags tags and --posts
+posts (1M by default), imports it with the same code as
+'flask blogly import', then exports it again as 'flask blogly export'
+does. Memory use stays flat for any file size, so peak RSS is
+printed next to the timings.
+
+    python -m benchmarks.bench_import --posts 100000 --chunk-size 5000
+    python -m benchmarks.bench_import --db postgresql:///blogly_bench
+"""
+import json
+import os
+import random
+import resource
+import tempfile
+
+from benchmarks.common import bench_app, parser, timed
+
+
+def write_corpus(path, users, tags, posts):
+    rng = random.Random(0)
+    names = [f'tag-{n}' for n in range(tags)]
+    with open(path, 'w', encoding='utf-8') as file:
+        for n in range(1, users + 1):
+            file.write(json.dumps(dict(type='user', id=n, first_name=f'First{n}', last_name=f'Last{n}')) + '\n')
+        for n in range(1, posts + 1):
+            record = dict(type='post', user_id=rng.randint(1, users), title=f'Post {n}',
+                          content='Lorem ipsum dolor sit amet. ' * 8, created_at='2021-07-01T12:00:00',
+                          tags=rng.sample(names, 3))
+            file.write(json.dumps(record) + '\n')
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    ap = parser(__doc__)
+    ap.add_argument('--users', type=int, default=10_000)
+    ap.add_argument('--tags', type=int, default=200)
+    ap.add_argument('--posts', type=int, default=1_000_000)
+    ap.add_argument('--chunk-size', type=int, default=5000)
+    args = ap.parse_args()
+
+    app = bench_app(args.db)
+    from cli import Importer, chunked, export_records, read_jsonl, write_jsonl
+    from models import db
+
+    fd, path = tempfile.mkstemp(prefix='blogly-import-', suffix='.jsonl')
+    os.close(fd)
+    try:
+        with timed('generate'):
+            write_corpus(path, args.users, args.tags, args.posts)
+        print(f'file size: {os.path.getsize(path) / 2 ** 20:.0f} MiB, peak RSS: {peak_rss_mb():.0f} MiB')
+
+        with app.app_context():
+            rows = args.users + args.tags + args.posts
+            with timed(f'import (chunks of {args.chunk_size})', rows):
+                importer = Importer(db.session)
+                with open(path, encoding='utf-8') as file:
+                    for chunk in chunked(read_jsonl(file), args.chunk_size):
+                        importer.write(chunk)
+                importer.finish()
+            print(f'peak RSS: {peak_rss_mb():.0f} MiB')
+
+            with timed('export', rows), open(os.devnull, 'w') as devnull:
+                write_jsonl(devnull, export_records(db.session, args.chunk_size))
+            print(f'peak RSS: {peak_rss_mb():.0f} MiB')
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
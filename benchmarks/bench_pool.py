@@ -0,0 +1,78 @@
+"""Request throughput as the connection pool size varies.
+
+Runs --threads concurrent clients against /users/<id> (with the
+application cache disabled, so every request checks out a connection)
+once per pool size. --latency adds a sleep to every statement to stand
+in for a remote database, which is what makes pool contention show up
+against a local SQLite file; against a real Postgres server pass 0.
+
+    python -m benchmarks.bench_pool --sizes 1,2,5,10 --threads 16
+    python -m benchmarks.bench_pool --db postgresql:///blogly_bench --latency 0
+"""
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+from benchmarks.common import bench_app, parser
+
+
+def main():
+    ap = parser(__doc__)
+    ap.add_argument('--sizes', default='1,2,5,10', help='comma separated pool sizes to try')
+    ap.add_argument('--threads', type=int, default=16, help='concurrent clients')
+    ap.add_argument('--requests', type=int, default=50, help='requests per client')
+    ap.add_argument('--latency', type=float, default=0.005, help='seconds of simulated latency per statement')
+    args = ap.parse_args()
+
+    os.environ['CACHE_MAXSIZE'] = '0'
+    app = bench_app(args.db)
+    from flask_sqlalchemy import get_state
+    from models import db, pool_options, User
+    from instrumentation import PoolStats
+
+    with app.app_context():
+        user = User(first_name='Pool', last_name='Bench')
+        db.session.add(user)
+        db.session.commit()
+        url = f'/users/{user.id}'
+
+    def slow_statement(*event_args):
+        time.sleep(args.latency)
+
+    def run_client(errors):
+        client = app.test_client()
+        for _ in range(args.requests):
+            if client.get(url).status_code != 200:
+                errors.append(1)
+
+    print(f'{"pool size":>9} {"req/s":>9} {"checkouts":>10} {"wait s":>8} {"max wait s":>10} {"errors":>7}')
+    for size in [int(n) for n in args.sizes.split(',')]:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = pool_options(app.config['SQLALCHEMY_DATABASE_URI'],
+                                                               size=size, max_overflow=0)
+        with app.app_context():
+            db.engine.dispose()
+            get_state(app).connectors.clear()
+            engine = db.engine
+        if args.latency:
+            event.listen(engine, 'before_cursor_execute', slow_statement)
+
+        errors = []
+        threads = [threading.Thread(target=run_client, args=(errors,)) for _ in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        stats = getattr(engine.pool, 'stats', PoolStats())
+        total = args.threads * args.requests
+        print(f'{size:>9} {total / elapsed:>9.1f} {stats.checkouts:>10} {stats.wait_seconds:>8.2f} '
+              f'{stats.max_wait_seconds:>10.3f} {len(errors):>7}')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
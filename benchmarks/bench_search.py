@@ -0,0 +1,74 @@
+"""Full-text search versus a LIKE scan over a generated corpus.
+
+Generates --posts posts of random words (100k by default), then times
+the same one-word queries through search_posts (FTS5 on SQLite, the
+GIN-indexed tsvector on Postgres) and through LIKE '%word%' over
+posts.content, which has to scan the whole table.
+
+    python -m benchmarks.bench_search --posts 100000
+"""
+import random
+import time
+from datetime import datetime
+
+from sqlalchemy import func
+
+from benchmarks.common import bench_app, parser, timed
+
+WORDS = ('bread garden river code music winter coffee travel paint chess '
+         'bicycle mountain novel kitchen python market forest ocean camera letter').split()
+
+
+def sentence(rng, n):
+    return ' '.join(rng.choice(WORDS) + str(rng.randrange(2000)) for _ in range(n))
+
+
+def main():
+    ap = parser(__doc__)
+    ap.add_argument('--posts', type=int, default=100000, help='posts in the corpus')
+    ap.add_argument('--queries', type=int, default=50, help='queries timed per method')
+    args = ap.parse_args()
+
+    app = bench_app(args.db)
+    from models import db, User, Post
+    from search import search_posts
+
+    rng = random.Random(1)
+    with app.app_context():
+        user = User(first_name='Search', last_name='Bench')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+        with timed(f'insert {args.posts} posts', rows=args.posts):
+            now = datetime.now()
+            for start in range(0, args.posts, 10000):
+                db.session.execute(Post.__table__.insert(), [
+                    dict(title=sentence(rng, 4), content=sentence(rng, 60), created_at=now, user_id=user_id)
+                    for _ in range(min(10000, args.posts - start))
+                ])
+            db.session.commit()
+
+        terms = [rng.choice(WORDS) + str(rng.randrange(2000)) for _ in range(args.queries)]
+
+        def full_text(term):
+            search_posts(db.session, term, page=1, per_page=20)
+
+        def like_scan(term):
+            (Post.query.with_entities(Post.id, Post.title)
+             .filter(func.lower(Post.content).like(f'%{term}%'))
+             .order_by(Post.id.desc()).limit(21).all())
+
+        for label, run in [('full-text index', full_text), ('LIKE scan', like_scan)]:
+            latencies = []
+            for term in terms:
+                start = time.perf_counter()
+                run(term)
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            print(f'{label:>16}: p50 {1000 * latencies[len(latencies) // 2]:8.2f} ms, '
+                  f'p99 {1000 * latencies[int(len(latencies) * 0.99)]:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Start-up time of a pre-fork worker pool.
+
+Does what 'gunicorn --preload --workers N wsgi:app' does, in a fresh
+interpreter each run: imports wsgi (building the app), forks --workers
+children, and waits until every child has served its first request.
+--latency adds a sleep to every new connection and every statement,
+to stand in for a remote database. Boot time and the connections the
+parent opened before forking should not move with it; only the first
+request in each worker pays for a connection.
+
+    python -m benchmarks.bench_startup --workers 8 --latency 0.05
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.common import bench_app, parser
+
+
+def boot(workers, latency):
+    """One run, in this (fresh) process. Prints a JSON summary."""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    connections = []
+
+    @event.listens_for(Engine, 'connect')
+    def slow_connect(*args):
+        connections.append(os.getpid())
+        time.sleep(latency)
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def slow_statement(*args):
+        time.sleep(latency)
+
+    start = time.perf_counter()
+    from wsgi import app
+    booted = time.perf_counter()
+    before_fork = len(connections)
+
+    pipes = []
+    for _ in range(workers):
+        read, write = os.pipe()
+        if os.fork() == 0:
+            os.close(read)
+            status = app.test_client().get('/tags').status_code
+            os.write(write, f'{status}\n'.encode())
+            os._exit(0)
+        os.close(write)
+        pipes.append(read)
+    statuses = []
+    for read in pipes:
+        with os.fdopen(read) as pipe:
+            statuses.append(int(pipe.read()))
+    ready = time.perf_counter()
+    for _ in pipes:
+        os.wait()
+
+    print(json.dumps(dict(boot=booted - start, ready=ready - start, connections_before_fork=before_fork,
+                          errors=sum(status != 200 for status in statuses))))
+
+
+def main():
+    ap = parser(__doc__)
+    ap.add_argument('--workers', type=int, default=4)
+    ap.add_argument('--latency', type=float, default=0.02, help='seconds of simulated latency per connect and statement')
+    ap.add_argument('--runs', type=int, default=5)
+    ap.add_argument('--boot', action='store_true', help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.boot:
+        boot(args.workers, args.latency)
+        return
+
+    app = bench_app(args.db)
+    env = dict(os.environ, SQLALCHEMY_DATABASE_URI=app.config['SQLALCHEMY_DATABASE_URI'])
+    command = [sys.executable, '-m', 'benchmarks.bench_startup', '--boot',
+               '--workers', str(args.workers), '--latency', str(args.latency)]
+    runs = [json.loads(subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout)
+            for _ in range(args.runs)]
+
+    print(f'{args.workers} workers, {args.latency * 1000:.0f} ms simulated latency, {args.runs} runs (median)')
+    print(f'  import and create_app:         {statistics.median(r["boot"] for r in runs) * 1000:8.1f} ms')
+    print(f'  until every worker has served: {statistics.median(r["ready"] for r in runs) * 1000:8.1f} ms')
+    print(f'  connections before fork:       {max(r["connections_before_fork"] for r in runs):8d}')
+    print(f'  failed first requests:         {sum(r["errors"] for r in runs):8d}')
+
+
+if __name__ == '__main__':
+    main()
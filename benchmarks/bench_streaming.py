@@ -0,0 +1,72 @@
+"""Time to first byte and memory use of a long tag page.
+
+Puts --posts posts (50,000 by default) under one tag and fetches the
+tag page through a real WSGI server, both streamed, as get_tag_by_id
+serves it, and buffered: every post loaded into a list and the page
+rendered whole with render_template, as it was served before. The
+application cache is off, so every request renders. Peak memory is
+the most tracemalloc saw allocated during a request, server and
+client together.
+
+    python -m benchmarks.bench_streaming --posts 50000
+"""
+import os
+import statistics
+import time
+import tracemalloc
+import urllib.request
+
+from benchmarks.common import bench_app, parser, serve_wsgi
+from benchmarks.datagen import generate
+
+
+def fetch(url):
+    """(seconds to the first byte, seconds to the last, bytes)"""
+    start = time.perf_counter()
+    with urllib.request.urlopen(url) as response:
+        first = response.read(1)
+        ttfb = time.perf_counter() - start
+        size = len(first) + len(response.read())
+    return ttfb, time.perf_counter() - start, size
+
+
+def main():
+    ap = parser(__doc__)
+    ap.add_argument('--posts', type=int, default=50000, help='posts with the tag')
+    ap.add_argument('--runs', type=int, default=5, help='timed requests per mode')
+    ap.add_argument('--port', type=int, default=8951)
+    args = ap.parse_args()
+
+    os.environ['CACHE_MAXSIZE'] = '0'
+    app = bench_app(args.db)
+    from flask import render_template
+    from app import load_tag, tag_posts
+
+    def buffered(tag_id):
+        tag = load_tag(tag_id)
+        posts = [dict(id=row.id, title=row.title) for row in tag_posts(tag_id)]
+        return render_template('one_tag.html', tag=dict(tag, posts=posts))
+
+    app.add_url_rule('/bench/buffered/<int:tag_id>', 'buffered', buffered)
+    generate(app, users=max(1, args.posts // 100), posts_per_user=min(100, args.posts), tags_per_post=1, tags=1)
+
+    stop = serve_wsgi(app, args.port)
+    base = f'http://127.0.0.1:{args.port}'
+    print(f'{"mode":<10} {"TTFB ms":>9} {"total ms":>9} {"peak MiB":>9} {"page KiB":>9}')
+    try:
+        for mode, url in [('streamed', f'{base}/tags/1'), ('buffered', f'{base}/bench/buffered/1')]:
+            fetch(url)
+            timings = [fetch(url) for _ in range(args.runs)]
+            tracemalloc.start()
+            size = fetch(url)[2]
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{mode:<10} {statistics.median(t[0] for t in timings) * 1000:9.1f} '
+                  f'{statistics.median(t[1] for t in timings) * 1000:9.1f} '
+                  f'{peak / 2 ** 20:9.1f} {size / 1024:9.0f}')
+    finally:
+        stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Commits and statements per request when saving a post's tags.
+
+Compares the old per-tag save loop (one PostTag insert and commit per
+checked tag) with the add_post and edit_post routes as they are now,
+driven through the test client. Each edit swaps the post between two
+halves of the tags, so every request changes its tags.
+
+    python -m benchmarks.bench_tag_sync --tags 50 --requests 200
+"""
+import time
+from datetime import datetime
+
+from benchmarks.common import StatementCounter, bench_app, parser
+
+
+def legacy_filter_tags_and_save(db, Tag, PostTag, post_id, names):
+    """The tag save loop as it was before sync_post_tags."""
+    for tag in Tag.query.all():
+        if tag.name in names:
+            db.session.add(PostTag(post_id=post_id, tag_id=tag.id))
+            db.session.commit()
+
+
+def main():
+    ap = parser(__doc__)
+    ap.add_argument('--tags', type=int, default=50, help='tags checked on every post')
+    ap.add_argument('--requests', type=int, default=200, help='posts created per run')
+    args = ap.parse_args()
+
+    app = bench_app(args.db)
+    from models import db, User, Post, Tag, PostTag
+
+    with app.app_context():
+        user = User(first_name='Bench', last_name='Mark')
+        db.session.add(user)
+        db.session.add_all(Tag(name=f'tag-{i}') for i in range(args.tags))
+        db.session.commit()
+        user_id = user.id
+        names = [f'tag-{i}' for i in range(args.tags)]
+        engine = db.engine
+
+        def legacy(n):
+            post = Post(title='t', content='c', created_at=datetime.now(), user_id=user_id)
+            db.session.add(post)
+            db.session.commit()
+            legacy_filter_tags_and_save(db, Tag, PostTag, post.id, names)
+
+    client = app.test_client()
+
+    def add_post(n):
+        resp = client.post(f'/users/{user_id}/posts/new', data=dict(title='t', content='c', tag=names))
+        assert resp.status_code == 302, resp.status_code
+
+    add_post(0)
+    with app.app_context():
+        post_id = db.session.query(db.func.max(Post.id)).scalar()
+    halves = [names[:len(names) // 2], names[len(names) // 2:]]
+
+    def edit_post(n):
+        resp = client.post(f'/posts/{post_id}/edit', data=dict(title=f't{n}', content='', tag=halves[n % 2]))
+        assert resp.status_code == 302, resp.status_code
+
+    for label, save in [('per-tag commits', legacy), ('add_post', add_post), ('edit_post', edit_post)]:
+        counter = StatementCounter()
+        start = time.perf_counter()
+        with counter.watch(engine):
+            for n in range(args.requests):
+                with app.app_context():
+                    save(n)
+        elapsed = time.perf_counter() - start
+        print(f'{label:>16}: {counter.commits / args.requests:6.1f} commits/request, '
+              f'{counter.statements / args.requests:6.1f} statements/request, '
+              f'{1000 * elapsed / args.requests:7.2f} ms/request')
+
+if __name__ == '__main__':
+    main()
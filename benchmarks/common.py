@@ -0,0 +1,96 @@
+"""Shared setup for the benchmark scripts.
+
+Benchmarks run against a throwaway SQLite file unless --db points
+them at another database (e.g. a local Postgres). Run them from the
+repository root, for example:
+
+    python -m benchmarks.bench_tag_sync --db postgresql:///blogly_bench
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+def parser(description):
+    """An argument parser with the options every benchmark takes."""
+    ap = argparse.ArgumentParser(description=description)
+    ap.add_argument('--db', help='database URI to benchmark against (default: a temporary SQLite file)')
+    return ap
+
+
+def temporary_sqlite():
+    """The URI of a new, empty SQLite file."""
+    fd, path = tempfile.mkstemp(prefix='blogly-bench-', suffix='.db')
+    os.close(fd)
+    return f'sqlite:///{path}'
+
+
+def bench_app(uri=None):
+    """Builds the app bound to `uri` and gives it an empty schema."""
+    if uri is None:
+        uri = temporary_sqlite()
+
+    from app import create_app
+    from models import db
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+class StatementCounter:
+    """Counts the SQL statements and commits an engine sees."""
+
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+
+    def _on_execute(self, *args):
+        self.statements += 1
+
+    def _on_commit(self, *args):
+        self.commits += 1
+
+    @contextmanager
+    def watch(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+        event.listen(engine, 'commit', self._on_commit)
+        try:
+            yield self
+        finally:
+            event.remove(engine, 'before_cursor_execute', self._on_execute)
+            event.remove(engine, 'commit', self._on_commit)
+
+
+@contextmanager
+def timed(label, rows=None):
+    """Prints how long the block took, and a rate when `rows` is given."""
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    if rows:
+        print(f'{label}: {elapsed:.3f}s ({rows / elapsed:,.0f} rows/s)')
+    else:
+        print(f'{label}: {elapsed:.3f}s')
+
+
+def serve_wsgi(app, port):
+    """Serves `app` with werkzeug's threaded server on a
+       background thread, without request logging. Returns
+       a function that stops it."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', port, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown
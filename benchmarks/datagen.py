@@ -0,0 +1,68 @@
+"""Synthetic data for the benchmarks.
+
+The same arguments and seed always produce the same rows. They are
+written through the bulk importer, so a large dataset loads in
+seconds and the post counters come out right.
+
+    python -m benchmarks.datagen --users 1000 --posts-per-user 10 --tags-per-post 3
+"""
+import random
+from datetime import datetime, timedelta
+
+from benchmarks.common import bench_app, parser, timed
+
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut '
+         'labore et dolore magna aliqua bread garden travel coffee music python flask database').split()
+
+
+def records(users, posts_per_user, tags_per_post, tags, seed=0):
+    """Yields import records: all the users first, then their posts."""
+    rng = random.Random(seed)
+    names = [f'tag-{n}' for n in range(tags)]
+    start = datetime(2021, 1, 1)
+    for n in range(users):
+        yield dict(type='user', first_name=f'First{n}', last_name=f'Last{n % 97}')
+    for n in range(users * posts_per_user):
+        yield dict(type='post', user_id=rng.randint(1, users),
+                   title=' '.join(rng.choices(WORDS, k=4)).capitalize(),
+                   content=' '.join(rng.choices(WORDS, k=60)),
+                   created_at=(start + timedelta(minutes=n)).isoformat(),
+                   tags=rng.sample(names, min(tags_per_post, tags)))
+
+
+def generate(app, users=1000, posts_per_user=10, tags_per_post=3, tags=100, seed=0, chunk_size=5000):
+    """Fills the app's (empty) database. Users get ids
+       1..users, which the posts refer to."""
+    from cli import Importer, chunked
+    from models import db
+
+    with app.app_context():
+        importer = Importer(db.session)
+        for chunk in chunked(records(users, posts_per_user, tags_per_post, tags, seed), chunk_size):
+            importer.write(chunk)
+        importer.finish()
+        return importer.counts
+
+
+def add_parser_options(ap):
+    ap.add_argument('--users', type=int, default=1000)
+    ap.add_argument('--posts-per-user', type=int, default=10)
+    ap.add_argument('--tags-per-post', type=int, default=3)
+    ap.add_argument('--tags', type=int, default=100, help='distinct tags')
+    ap.add_argument('--seed', type=int, default=0)
+
+
+def main():
+    ap = parser(__doc__)
+    add_parser_options(ap)
+    args = ap.parse_args()
+    app = bench_app(args.db)
+    rows = args.users * (1 + args.posts_per_user)
+    with timed('generate', rows):
+        counts = generate(app, args.users, args.posts_per_user, args.tags_per_post, args.tags, args.seed)
+    print(', '.join(f'{n} {kind}s' for kind, n in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+"""Timed scenarios for every route in app.py.
+
+Fills a fresh database with benchmarks.datagen, then runs each
+scenario --requests times and reports throughput, p50/p95/p99 latency
+and SQL statements per request. Requests go through app.test_client()
+by default, or over HTTP to werkzeug's threaded server with --server.
+Write scenarios (adding, editing and deleting) work on rows made for
+them beforehand, so every run sees the same data. The application
+cache is off unless --cache is given: read scenarios repeat the same
+few pages, which would otherwise be timed as cache hits that run no
+SQL at all.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --server --concurrency 8 --only show_user,feed
+    python -m benchmarks.run --baseline results.json
+
+With --baseline, the run exits with status 1 if any scenario runs
+more SQL statements per request than the baseline did, or if its p95
+latency is more than --tolerance slower (ignoring differences under
+--noise-ms). Baselines are only comparable on the same machine and
+with the same dataset options.
+"""
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from benchmarks.common import StatementCounter, bench_app, parser, serve_wsgi
+from benchmarks.datagen import WORDS, add_parser_options, generate
+
+
+class Dataset:
+    """Ids to aim requests at, and rows made to order for the
+       scenarios that consume them."""
+
+    def __init__(self, app):
+        from models import db, User, Post, Tag
+
+        self.app = app
+        self.token = uuid.uuid4().hex[:8]
+        with app.app_context():
+            self.user_ids = [n for n, in db.session.query(User.id).order_by(User.id)]
+            self.post_ids = [n for n, in db.session.query(Post.id).order_by(Post.id)]
+            self.tag_ids = [n for n, in db.session.query(Tag.id).order_by(Tag.id)]
+            self.tag_names = [name for name, in db.session.query(Tag.name).order_by(Tag.id)]
+        client = app.test_client()
+        self.users_next_page = self.next_link(client, '/users')
+        self.feed_next_page = self.next_link(client, '/posts')
+
+    @staticmethod
+    def next_link(client, path):
+        html = client.get(path).get_data(as_text=True)
+        for link in html.split('href="')[1:]:
+            link = link.split('"', 1)[0].replace('&amp;', '&')
+            if '?after=' in link:
+                return link
+        return path
+
+    def pick(self, ids, n):
+        return ids[(n * 7919) % len(ids)]
+
+    def tags_for(self, n):
+        return [self.tag_names[(n + k) % len(self.tag_names)] for k in range(3)]
+
+    def make(self, kind, count):
+        """Imports `count` fresh rows of `kind` and returns their ids."""
+        from cli import Importer
+        from models import db, Tag
+
+        with self.app.app_context():
+            importer = Importer(db.session)
+            if kind == 'user':
+                rows = [dict(type='user', first_name='Spare', last_name=f'User{n}') for n in range(count)]
+            elif kind == 'tag':
+                rows = [dict(type='tag', name=f'spare-{self.token}-{n}') for n in range(count)]
+            else:
+                rows = [dict(type='post', user_id=self.pick(self.user_ids, n), title='Spare', content='spare post',
+                             tags=self.tags_for(n)) for n in range(count)]
+            importer.write(rows)
+            if kind == 'tag':
+                ids = dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_([row['name'] for row in rows])))
+                return [ids[row['name']] for row in rows]
+            return [row['id'] for row in rows]
+
+
+def get(path_for):
+    def build(data, count):
+        return [('GET', path_for(data, n), None) for n in range(count)]
+    return build
+
+
+def post(path_for, form_for):
+    def build(data, count):
+        return [('POST', path_for(data, n), form_for(data, n)) for n in range(count)]
+    return build
+
+
+def consume(kind, path_for):
+    def build(data, count):
+        return [('GET', path_for(victim), None) for victim in data.make(kind, count)]
+    return build
+
+
+def edit_made(kind, path_for, form_for):
+    def build(data, count):
+        return [('POST', path_for(victim), form_for(data, n)) for n, victim in enumerate(data.make(kind, count))]
+    return build
+
+
+SCENARIOS = [
+    ('home', get(lambda d, n: '/')),
+    ('user_list', get(lambda d, n: '/users')),
+    ('user_list_page_2', get(lambda d, n: d.users_next_page)),
+    ('show_user', get(lambda d, n: f'/users/{d.pick(d.user_ids, n)}')),
+    ('feed', get(lambda d, n: '/posts')),
+    ('feed_page_2', get(lambda d, n: d.feed_next_page)),
+    ('show_post', get(lambda d, n: f'/posts/{d.pick(d.post_ids, n)}')),
+    ('show_tags', get(lambda d, n: '/tags')),
+    ('show_tags_popular', get(lambda d, n: '/tags?sort=popular')),
+    ('get_tag_by_id', get(lambda d, n: f'/tags/{d.pick(d.tag_ids, n)}')),
+    ('search', get(lambda d, n: f'/search?q={WORDS[n % len(WORDS)]}')),
+    ('metrics', get(lambda d, n: '/metrics')),
+    ('not_found', get(lambda d, n: '/404')),
+    ('add_user_form', get(lambda d, n: '/users/new')),
+    ('edit_profile_form', get(lambda d, n: f'/users/{d.pick(d.user_ids, n)}/edit')),
+    ('add_post_form', get(lambda d, n: f'/users/{d.pick(d.user_ids, n)}/posts/new')),
+    ('edit_post_form', get(lambda d, n: f'/posts/{d.pick(d.post_ids, n)}/edit')),
+    ('add_tag_form', get(lambda d, n: '/tags/new')),
+    ('edit_tag_form', get(lambda d, n: f'/tags/{d.pick(d.tag_ids, n)}/edit')),
+    ('add_user', post(lambda d, n: '/users/new',
+                      lambda d, n: dict(first='Bench', last=f'User{n}', image=''))),
+    ('edit_profile', post(lambda d, n: f'/users/{d.pick(d.user_ids, n)}/edit',
+                          lambda d, n: dict(first_name=f'Edited{n}', last_name='', image_url=''))),
+    ('add_post', post(lambda d, n: f'/users/{d.pick(d.user_ids, n)}/posts/new',
+                      lambda d, n: dict(title=f'Bench post {n}', content='lorem ipsum ' * 20, tag=d.tags_for(n)))),
+    ('edit_post', post(lambda d, n: f'/posts/{d.pick(d.post_ids, n)}/edit',
+                       lambda d, n: dict(title=f'Edited {n}', content='dolor sit ' * 20, tag=d.tags_for(n + 1)))),
+    ('add_tag', post(lambda d, n: '/tags/new', lambda d, n: dict(newtag=f'bench-{d.token}-{n}'))),
+    ('edit_tag', edit_made('tag', lambda tag_id: f'/tags/{tag_id}/edit',
+                           lambda d, n: dict(changedtag=f'renamed-{d.token}-{n}'))),
+    ('delete_post', consume('post', lambda post_id: f'/posts/{post_id}/delete')),
+    ('delete_user', consume('user', lambda user_id: f'/users/{user_id}/delete')),
+    ('delete_tag', consume('tag', lambda tag_id: f'/tags/{tag_id}/delete')),
+]
+
+
+def run_client(app, requests):
+    """Sends the requests one at a time through the test
+       client, reading each body in full (streamed pages are
+       rendered as they are read); returns their latencies
+       and the error count."""
+    client = app.test_client()
+    latencies, errors = [], 0
+    for method, path, form in requests:
+        start = time.perf_counter()
+        response = client.open(path, method=method, data=form)
+        response.get_data()
+        response.close()
+        latencies.append(time.perf_counter() - start)
+        errors += response.status_code >= 400
+    return latencies, errors
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def run_server(base, requests, concurrency):
+    """Sends the requests over HTTP from `concurrency` threads."""
+    opener = urllib.request.build_opener(NoRedirect)
+    latencies, errors = [], []
+    lock = threading.Lock()
+    pending = iter(requests)
+
+    def worker():
+        while True:
+            with lock:
+                item = next(pending, None)
+            if item is None:
+                return
+            method, path, form = item
+            body = urllib.parse.urlencode(form, doseq=True).encode() if form else None
+            start = time.perf_counter()
+            try:
+                with opener.open(urllib.request.Request(base + path, data=body, method=method)) as response:
+                    response.read()
+                    failed = False
+            except urllib.error.HTTPError as exc:
+                failed = exc.code >= 400
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors.append(failed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, sum(errors)
+
+
+def summarize(latencies, elapsed, statements, errors):
+    cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return dict(requests=len(latencies), errors=errors,
+                throughput=round(len(latencies) / elapsed, 1),
+                p50_ms=round(cuts[49] * 1000, 3), p95_ms=round(cuts[94] * 1000, 3), p99_ms=round(cuts[98] * 1000, 3),
+                statements_per_request=round(statements / len(latencies), 2))
+
+
+def regressions(results, baseline, tolerance, noise_ms):
+    """Scenarios that got worse than the baseline, as messages."""
+    found = []
+    for name, now in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        if now['statements_per_request'] > before['statements_per_request'] + 0.01:
+            found.append(f'{name}: {before["statements_per_request"]} -> {now["statements_per_request"]} '
+                         f'SQL statements per request')
+        if (now['p95_ms'] > before['p95_ms'] * (1 + tolerance)
+                and now['p95_ms'] - before['p95_ms'] > noise_ms):
+            found.append(f'{name}: p95 {before["p95_ms"]}ms -> {now["p95_ms"]}ms')
+    return found
+
+
+def main():
+    ap = parser(__doc__)
+    add_parser_options(ap)
+    ap.add_argument('--requests', type=int, default=200, help='timed requests per scenario')
+    ap.add_argument('--warmup', type=int, default=5, help='untimed requests before each scenario')
+    ap.add_argument('--only', help='comma separated scenario names to run')
+    ap.add_argument('--server', action='store_true', help='go through a real WSGI server instead of test_client')
+    ap.add_argument('--concurrency', type=int, default=4, help='client threads in --server mode')
+    ap.add_argument('--port', type=int, default=8941)
+    ap.add_argument('--cache', action='store_true', help='leave the application cache on (measures cache hits)')
+    ap.add_argument('--output', help='write the results to this JSON file')
+    ap.add_argument('--baseline', help='JSON results to compare against')
+    ap.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 slowdown, as a fraction')
+    ap.add_argument('--noise-ms', type=float, default=1.0, help='p95 differences below this are ignored')
+    args = ap.parse_args()
+
+    if not args.cache:
+        os.environ['CACHE_MAXSIZE'] = '0'
+    app = bench_app(args.db)
+    from models import db
+
+    generate(app, args.users, args.posts_per_user, args.tags_per_post, args.tags, args.seed)
+    data = Dataset(app)
+    with app.app_context():
+        engine = db.engine
+
+    only = set(args.only.split(',')) if args.only else None
+    stop = serve_wsgi(app, args.port) if args.server else None
+    base = f'http://127.0.0.1:{args.port}'
+    results = dict(meta=dict(mode='server' if args.server else 'client', concurrency=args.concurrency,
+                             cache=args.cache,
+                             users=args.users, posts_per_user=args.posts_per_user,
+                             tags_per_post=args.tags_per_post, tags=args.tags, requests=args.requests,
+                             database=engine.dialect.name, python=platform.python_version(),
+                             started=time.strftime('%Y-%m-%dT%H:%M:%S')),
+                   scenarios={})
+
+    print(f'{"scenario":<20} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"SQL/req":>8} {"errors":>7}')
+    try:
+        for name, build in SCENARIOS:
+            if only and name not in only:
+                continue
+            requests = build(data, args.warmup + args.requests)
+            warmup, requests = requests[:args.warmup], requests[args.warmup:]
+            send = ((lambda batch: run_server(base, batch, args.concurrency)) if args.server
+                    else (lambda batch: run_client(app, batch)))
+            send(warmup)
+            with StatementCounter().watch(engine) as counter:
+                start = time.perf_counter()
+                latencies, errors = send(requests)
+                elapsed = time.perf_counter() - start
+            row = summarize(latencies, elapsed, counter.statements, errors)
+            results['scenarios'][name] = row
+            print(f'{name:<20} {row["throughput"]:>9.1f} {row["p50_ms"]:>8.2f} {row["p95_ms"]:>8.2f} '
+                  f'{row["p99_ms"]:>8.2f} {row["statements_per_request"]:>8.2f} {row["errors"]:>7}')
+    finally:
+        if stop:
+            stop()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            found = regressions(results, json.load(file), args.tolerance, args.noise_ms)
+        for message in found:
+            print(f'REGRESSION {message}')
+        if found:
+            sys.exit(1)
+        print('no regressions against the baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+import hashlib
+import pickle
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from contextlib import nullcontext
+
+from sqlalchemy import event
+
+
+MISSING = object()
+
+
+class CacheBackend(ABC):
+    """The storage interface the Cache sits on. get returns
+       MISSING for keys that are absent or expired."""
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+
+class LRUCache(CacheBackend):
+    """An in-process, thread-safe LRU cache whose entries
+       also expire `ttl` seconds after they are set."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedCache(CacheBackend):
+    """A backend shared between processes, on top of any client
+       with the pymemcache interface: get(key), set(key, value,
+       expire=seconds), delete(key) and flush_all(). Values are
+       pickled, so they must be plain data rather than ORM objects."""
+
+    def __init__(self, client, ttl=300, prefix='blogly:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, key):
+        # Cache keys are made from reprs of cursors and may hold
+        # spaces or run long; memcached allows neither.
+        return self.prefix + hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, key):
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            return MISSING
+        return pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self._key(key), pickle.dumps(value), expire=ttl or 0)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        self.client.flush_all()
+
+
+class LocalSharedClient:
+    """A dict-backed stand-in for a memcached client, for
+       tests and single-process setups. It refuses the keys
+       memcached would: longer than 250 bytes, or holding
+       whitespace or control characters."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _check(key):
+        raw = key.encode()
+        if len(raw) > 250 or any(byte <= 32 or byte == 127 for byte in raw):
+            raise ValueError(f'illegal memcached key {key!r}')
+
+    def get(self, key):
+        self._check(key)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires and expires <= time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, expire=0):
+        self._check(key)
+        with self._lock:
+            self._data[key] = (time.time() + expire if expire else 0, value)
+        return True
+
+    def delete(self, key):
+        self._check(key)
+        with self._lock:
+            self._data.pop(key, None)
+        return True
+
+    def flush_all(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+
+def memcached_backend(url, ttl):
+    """A SharedCache talking to the memcached server at
+       host:port. Needs the optional pymemcache package."""
+    try:
+        from pymemcache.client.base import Client
+    except ImportError as exc:
+        raise RuntimeError('CACHE_BACKEND=memcached needs the pymemcache package') from exc
+    host, _, port = url.partition(':')
+    return SharedCache(Client((host, int(port or 11211))), ttl=ttl)
+
+
+class Cache:
+    """A read-through cache for database lookups.
+
+       Entries live in a namespace ('user', 'tags', ...) under a
+       key. A namespace carries a generation token that is part of
+       every key in it, so a whole namespace is invalidated at once
+       by replacing the token; the old entries simply become
+       unreachable and age out of the backend. Each entry has a
+       version token of its own, replaced the same way to
+       invalidate just that entry."""
+
+    def __init__(self, backend, load_context=None):
+        self.backend = backend
+        self.load_context = load_context
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def _token(self, name):
+        token = self.backend.get(name)
+        if token is MISSING:
+            token = uuid.uuid4().hex[:12]
+            self.backend.set(name, token, ttl=0)
+        return token
+
+    def slot(self, namespace, key):
+        """The backend key the entry lives under right now.
+
+           The namespace generation and the entry's own version
+           are both part of it, so resolve it before reading the
+           database: if a write invalidates the entry while the
+           value is being loaded, storing into this slot afterwards
+           leaves the stale value unreachable instead of serving it."""
+        generation = self._token(f'generation:{namespace}')
+        version = self._token(f'version:{namespace}:{key}')
+        return f'{namespace}:{generation}:{key}:{version}'
+
+    def lookup(self, namespace, slot):
+        """Returns the value in `slot`, or None on a miss."""
+        value = self.backend.get(slot)
+        if value is MISSING:
+            self.misses[namespace] += 1
+            return None
+        self.hits[namespace] += 1
+        return value
+
+    def store(self, slot, value):
+        self.backend.set(slot, value)
+
+    def loading(self):
+        """The context to load a value to be cached in, made by
+           `load_context` if one was given."""
+        return self.load_context() if self.load_context is not None else nullcontext()
+
+    def get(self, namespace, key):
+        """Returns the cached value, or None on a miss."""
+        return self.lookup(namespace, self.slot(namespace, key))
+
+    def set(self, namespace, key, value):
+        self.store(self.slot(namespace, key), value)
+
+    def get_or_load(self, namespace, key, loader):
+        """Returns the cached value, or calls `loader`, caches
+           and returns its result. A None result is not cached."""
+        slot = self.slot(namespace, key)
+        value = self.lookup(namespace, slot)
+        if value is None:
+            with self.loading():
+                value = loader()
+            if value is not None:
+                self.store(slot, value)
+        return value
+
+    def invalidate(self, namespace, key=None):
+        """Drops one entry, or the whole namespace when key is None,
+           by replacing the token its slot is made from."""
+        if key is None:
+            self.backend.set(f'generation:{namespace}', uuid.uuid4().hex[:12], ttl=0)
+        else:
+            self.backend.set(f'version:{namespace}:{key}', uuid.uuid4().hex[:12], ttl=0)
+
+    def clear(self):
+        self.backend.clear()
+
+    def metrics(self):
+        """Hit and miss counters in Prometheus text format."""
+        yield '# HELP blogly_cache_hits_total Cache lookups answered from the cache.'
+        yield '# TYPE blogly_cache_hits_total counter'
+        for namespace, n in sorted(self.hits.items()):
+            yield f'blogly_cache_hits_total{{namespace="{namespace}"}} {n}'
+        yield '# HELP blogly_cache_misses_total Cache lookups that went to the database.'
+        yield '# TYPE blogly_cache_misses_total counter'
+        for namespace, n in sorted(self.misses.items()):
+            yield f'blogly_cache_misses_total{{namespace="{namespace}"}} {n}'
+
+
+def watch(session, cache_for, stale_for, table_namespaces):
+    """Invalidates cache entries when `session` commits writes.
+
+       cache_for(session) returns the Cache of the app the session
+       is working for, or None when it has none. For objects
+       written through the unit of work, stale_for(obj) names the
+       (namespace, key) entries the object feeds; key None means
+       the whole namespace. Bulk statements either name their
+       entries in an `invalidates` execution option, or drop every
+       namespace listed for their table in `table_namespaces`.
+       Nothing is invalidated until the transaction commits, and a
+       rollback forgets it."""
+
+    def pending(session):
+        return session.info.setdefault('cache_stale', set())
+
+    @event.listens_for(session, 'after_flush')
+    def collect_flushed(session, flush_context):
+        stale = pending(session)
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            stale.update(stale_for(obj))
+
+    @event.listens_for(session, 'do_orm_execute')
+    def collect_bulk(orm_execute_state):
+        if not (orm_execute_state.is_insert or orm_execute_state.is_update
+                or orm_execute_state.is_delete):
+            return
+        stale = pending(orm_execute_state.session)
+        explicit = orm_execute_state.execution_options.get('invalidates')
+        if explicit is not None:
+            stale.update(explicit)
+            return
+        table = orm_execute_state.statement.table
+        stale.update((namespace, None) for namespace in table_namespaces.get(table.name, ()))
+
+    @event.listens_for(session, 'after_commit')
+    def apply_stale(session):
+        stale = session.info.pop('cache_stale', set())
+        cache = cache_for(session)
+        if cache is None:
+            return
+        for namespace, key in stale:
+            if key is None or (namespace, None) not in stale:
+                cache.invalidate(namespace, key)
+
+    @event.listens_for(session, 'after_soft_rollback')
+    def forget_stale(session, previous_transaction):
+        session.info.pop('cache_stale', None)
@@ -0,0 +1,401 @@
+import csv
+import io
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.sql.elements import ClauseElement
+from sqlalchemy.exc import IntegrityError
+
+from models import db, DEFAULT_IMAGE_URL, User, Post, Tag, PostTag
+from search import create_search_index
+from counters import adjust_tag_counts, adjust_user_counts, counter_drift, rebuild_counters
+
+
+blogly = AppGroup('blogly', help='Schema, template and bulk data commands for Blogly.')
+
+CSV_FIELDS = ['type', 'id', 'first_name', 'last_name', 'image_url',
+              'name', 'user_id', 'title', 'content', 'created_at', 'tags']
+
+EXPORT_COLUMNS = {
+    'user': (User.id, User.first_name, User.last_name, User.image_url),
+    'tag': (Tag.id, Tag.name),
+    'post': (Post.id, Post.user_id, Post.title, Post.content, Post.created_at),
+}
+
+
+def read_jsonl(file):
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+CSV_OPTIONAL = {'id', 'image_url', 'name', 'created_at', 'tags'}
+
+
+def read_csv(file):
+    """CSV rows carry every field; the ones that do not apply
+       to a row's type are left empty. Empty optional fields are
+       dropped, but an empty title or content is kept as it is.
+       Tags are a JSON list."""
+    for row in csv.DictReader(file):
+        record = {key: value for key, value in row.items()
+                  if value is not None and not (value == '' and key in CSV_OPTIONAL)}
+        if 'tags' in record:
+            record['tags'] = json.loads(record['tags'])
+        yield record
+
+
+def write_jsonl(file, records):
+    for record in records:
+        file.write(json.dumps(record, separators=(',', ':')))
+        file.write('\n')
+
+
+def write_csv(file, records):
+    writer = csv.DictWriter(file, CSV_FIELDS)
+    writer.writeheader()
+    for record in records:
+        if 'tags' in record:
+            record = dict(record, tags=json.dumps(record['tags']))
+        writer.writerow(record)
+
+
+FORMATS = {'jsonl': (read_jsonl, write_jsonl), 'csv': (read_csv, write_csv)}
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Importer:
+    """Writes user, tag and post records to the database in chunks.
+
+       Each chunk is a handful of executemany INSERTs in one
+       transaction, whatever its size: tag names on posts are
+       resolved to ids with one IN query, and tags that do not
+       exist yet are created on the way. Records that carry an id
+       keep it; the others are numbered on from the highest id in
+       the table when the import started."""
+
+    def __init__(self, session):
+        self.session = session
+        self.next_id = {}
+        for model in (User, Tag, Post):
+            highest = session.query(func.max(model.id)).scalar() or 0
+            self.next_id[model] = highest + 1
+        self.counts = dict(user=0, tag=0, post=0)
+
+    def assign_id(self, model, record):
+        if record.get('id') is None:
+            record['id'] = self.next_id[model]
+        record['id'] = int(record['id'])
+        self.next_id[model] = max(self.next_id[model], record['id'] + 1)
+        return record['id']
+
+    def tag_ids(self, names, given):
+        """Ids for the tag `names`, creating the missing tags
+           with the id in `given` if there is one."""
+        ids = dict(self.session.query(Tag.name, Tag.id).filter(Tag.name.in_(names)))
+        missing = [name for name in names if name not in ids]
+        if missing:
+            rows = [dict(id=self.assign_id(Tag, dict(id=given.get(name))), name=name) for name in missing]
+            self.session.execute(Tag.__table__.insert(), rows)
+            ids.update((row['name'], row['id']) for row in rows)
+            self.counts['tag'] += len(rows)
+        return ids
+
+    def write(self, records):
+        """Inserts one chunk of records and commits it."""
+        users, tags, posts = [], {}, []
+        for record in records:
+            kind = record.get('type')
+            if kind == 'user':
+                users.append(dict(id=self.assign_id(User, record), first_name=record['first_name'],
+                                  last_name=record['last_name'],
+                                  image_url=record.get('image_url') or DEFAULT_IMAGE_URL))
+            elif kind == 'tag':
+                tags[record['name']] = record.get('id')
+            elif kind == 'post':
+                posts.append(record)
+            else:
+                raise click.ClickException(f'unknown record type {kind!r}')
+
+        if users:
+            self.session.execute(User.__table__.insert(), users)
+            self.counts['user'] += len(users)
+        tag_names = set(tags)
+        for post in posts:
+            tag_names.update(post.get('tags', ()))
+        tag_ids = self.tag_ids(tag_names, tags) if tag_names else {}
+
+        if posts:
+            rows, links = [], []
+            for post in posts:
+                post_id = self.assign_id(Post, post)
+                created_at = post.get('created_at')
+                rows.append(dict(id=post_id, user_id=int(post['user_id']), title=post['title'],
+                                 content=post['content'],
+                                 created_at=datetime.fromisoformat(created_at) if created_at else datetime.now()))
+                links.extend(dict(post_id=post_id, tag_id=tag_ids[name]) for name in set(post.get('tags', ())))
+            self.session.execute(Post.__table__.insert(), rows)
+            if links:
+                self.session.execute(PostTag.__table__.insert(), links)
+            adjust_user_counts(self.session, Counter(row['user_id'] for row in rows))
+            adjust_tag_counts(self.session, Counter(link['tag_id'] for link in links))
+            self.counts['post'] += len(rows)
+        self.session.commit()
+
+    def finish(self):
+        """Moves Postgres' id sequences past the imported ids.
+           Called after a failed chunk too, for the ones before it."""
+        if self.session.bind.dialect.name == 'postgresql':
+            for model in (User, Tag, Post):
+                table = model.__tablename__
+                self.session.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                                          f"coalesce(max(id), 0) + 1, false) FROM {table}"))
+            self.session.commit()
+
+
+def export_records(session, chunk_size):
+    """Yields every user, then every tag, then every post as
+       records. Rows are streamed from a server-side cursor a
+       chunk at a time, and each chunk of posts gets its tag
+       names with one query, so memory use does not grow with
+       the size of the database."""
+    for kind in ('user', 'tag'):
+        columns = EXPORT_COLUMNS[kind]
+        result = session.execute(select(*columns).order_by(columns[0]).execution_options(yield_per=chunk_size))
+        for rows in result.partitions(chunk_size):
+            for row in rows:
+                yield dict(type=kind, **row._asdict())
+
+    columns = EXPORT_COLUMNS['post']
+    result = session.execute(select(*columns).order_by(Post.id).execution_options(yield_per=chunk_size))
+    for rows in result.partitions(chunk_size):
+        tags = {row.id: [] for row in rows}
+        names = (session.query(PostTag.post_id, Tag.name)
+                 .join(Tag, Tag.id == PostTag.tag_id)
+                 .filter(PostTag.post_id.in_(list(tags)))
+                 .order_by(PostTag.post_id, Tag.name))
+        for post_id, name in names:
+            tags[post_id].append(name)
+        for row in rows:
+            record = dict(type='post', **row._asdict())
+            record['created_at'] = record['created_at'].isoformat()
+            record['tags'] = tags[row.id]
+            yield record
+
+
+def report(action, counts, elapsed):
+    total = sum(counts.values())
+    detail = ', '.join(f'{n} {kind}s' for kind, n in counts.items())
+    click.echo(f'{action} {detail} in {elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} rows/s)', err=True)
+
+
+def format_of(path, fmt):
+    if fmt is None:
+        fmt = 'csv' if path.endswith('.csv') else 'jsonl'
+    return fmt
+
+
+@contextmanager
+def open_data(path, mode):
+    """Opens PATH ('-' for stdin or stdout) as UTF-8 text with
+       newline='', as the csv module expects, so line breaks
+       inside fields are read and written exactly as they are."""
+    if path != '-':
+        with open(path, mode, encoding='utf-8', newline='') as file:
+            yield file
+        return
+    file = io.TextIOWrapper(click.get_binary_stream('stdin' if mode == 'r' else 'stdout'),
+                            encoding='utf-8', newline='')
+    try:
+        yield file
+    finally:
+        file.flush()
+        file.detach()
+
+
+@blogly.command('import')
+@click.argument('source', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)),
+              help='jsonl or csv; taken from the file extension by default.')
+@click.option('--chunk-size', default=5000, show_default=True, help='Records written per transaction.')
+def import_command(source, fmt, chunk_size):
+    """Imports users, tags and posts from SOURCE ('-' for stdin).
+
+       Users must come before their posts, as in the output of
+       'flask blogly export'."""
+    reader = FORMATS[format_of(source, fmt)][0]
+    importer = Importer(db.session)
+    start = time.perf_counter()
+    try:
+        with open_data(source, 'r') as file:
+            chunks = chunked(reader(file), chunk_size)
+            n = 0
+            while True:
+                n += 1
+                try:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    importer.write(chunk)
+                except IntegrityError as exc:
+                    db.session.rollback()
+                    raise click.ClickException(f'chunk {n} was rejected, earlier chunks are kept: {exc.orig}')
+                except (KeyError, ValueError) as exc:
+                    db.session.rollback()
+                    raise click.ClickException(f'chunk {n} has a bad record, earlier chunks are kept: {exc!r}')
+    finally:
+        db.session.rollback()
+        importer.finish()
+    report('Imported', importer.counts, time.perf_counter() - start)
+
+
+@blogly.command('export')
+@click.argument('target', type=click.Path(dir_okay=False, writable=True, allow_dash=True), default='-')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)),
+              help='jsonl or csv; taken from the file extension by default.')
+@click.option('--chunk-size', default=5000, show_default=True, help='Rows fetched from the database at a time.')
+def export_command(target, fmt, chunk_size):
+    """Exports every user, tag and post to TARGET (stdout by default)."""
+    writer = FORMATS[format_of(target, fmt)][1]
+    counts = dict(user=0, tag=0, post=0)
+
+    def counted(records):
+        for record in records:
+            counts[record['type']] += 1
+            yield record
+
+    start = time.perf_counter()
+    with open_data(target, 'w') as file:
+        writer(file, counted(export_records(db.session, chunk_size)))
+    report('Exported', counts, time.perf_counter() - start)
+
+
+@blogly.command('recount')
+@click.option('--check', is_flag=True, help='Only report drift; exit with status 1 if there is any.')
+def recount_command(check):
+    """Checks the stored post counts of users and tags against
+       the posts themselves, and rebuilds the wrong ones."""
+    drift = counter_drift(db.session)
+    for table, rows in drift.items():
+        for row_id, stored, actual in rows:
+            click.echo(f'{table} {row_id}: stored {stored}, actual {actual}')
+    total = sum(len(rows) for rows in drift.values())
+    if check:
+        click.echo(f'{total} counters out of step', err=True)
+        if total:
+            raise SystemExit(1)
+        return
+    rebuild_counters(db.session)
+    db.session.commit()
+    click.echo(f'Rebuilt {total} counters', err=True)
+
+
+@blogly.command('init-db')
+def init_db_command():
+    """Creates any missing tables and indexes, and the search
+       index with the posts table. Existing tables are left as
+       they are; run upgrade-db to bring them up to date."""
+    db.create_all()
+    click.echo(f'Created the schema in {db.engine.url!r}', err=True)
+
+
+@blogly.command('search-index')
+def search_index_command():
+    """Adds the full-text search index to an existing posts
+       table, if it is missing, and re-indexes every post."""
+    create_search_index(db.session)
+    db.session.commit()
+    click.echo(f'Indexed the posts in {db.engine.url!r}', err=True)
+
+
+def column_ddl(column, dialect):
+    """ALTER TABLE statements that add `column` to a table that
+       already has rows. SQLite cannot add a column whose default
+       is an expression, so there the column gets a constant
+       default and is filled in with the expression afterwards."""
+    table = column.table.name
+    kind = column.type.compile(dialect=dialect)
+    if column.server_default is None:
+        return [f'ALTER TABLE {table} ADD COLUMN {column.name} {kind}']
+    default = column.server_default.arg
+    if not isinstance(default, ClauseElement):
+        return [f"ALTER TABLE {table} ADD COLUMN {column.name} {kind} NOT NULL DEFAULT '{default}'"]
+    expression = default.compile(dialect=dialect)
+    if dialect.name != 'sqlite':
+        return [f'ALTER TABLE {table} ADD COLUMN {column.name} {kind} NOT NULL DEFAULT {expression}']
+    return [f"ALTER TABLE {table} ADD COLUMN {column.name} {kind} NOT NULL DEFAULT '1970-01-01 00:00:00'",
+            f'UPDATE {table} SET {column.name} = {expression}']
+
+
+def upgrade_schema(session):
+    """Brings a database made by an earlier Blogly up to date:
+       creates missing tables, adds missing columns (every column
+       added since the first release has a server default) and
+       missing indexes. Yields a line for each change."""
+    connection = session.connection()
+    db.Model.metadata.create_all(connection)
+    inspector = inspect(connection)
+    for table in db.Model.metadata.sorted_tables:
+        present = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in present:
+                for statement in column_ddl(column, connection.dialect):
+                    session.execute(text(statement))
+                yield f'added {table.name}.{column.name}'
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(connection)
+                yield f'created index {index.name}'
+
+
+@blogly.command('upgrade-db')
+def upgrade_db_command():
+    """Adds the tables, columns and indexes a database created
+       by an earlier version is missing, installs the search
+       index and recounts the stored post counts. Safe to run
+       more than once."""
+    for change in upgrade_schema(db.session):
+        click.echo(change, err=True)
+    create_search_index(db.session)
+    rebuild_counters(db.session)
+    db.session.commit()
+    click.echo(f'Upgraded the schema in {db.engine.url!r}', err=True)
+
+
+@blogly.command('drop-db')
+@click.confirmation_option(prompt='Drop every Blogly table and its data?')
+def drop_db_command():
+    """Drops every table, with all of its data."""
+    db.drop_all()
+    click.echo(f'Dropped the schema in {db.engine.url!r}', err=True)
+
+
+@blogly.command('compile-templates')
+def compile_templates_command():
+    """Compiles every template into the Jinja bytecode cache
+       (JINJA_BYTECODE_CACHE_DIR), so that workers started after
+       a deploy load them without compiling them first."""
+    env = current_app.jinja_env
+    if env.bytecode_cache is None:
+        raise click.ClickException('JINJA_BYTECODE_CACHE_DIR is not set')
+    names = env.list_templates(extensions=['html'])
+    for name in names:
+        env.get_template(name)
+    click.echo(f"Compiled {len(names)} templates into {current_app.config['JINJA_BYTECODE_CACHE_DIR']}", err=True)
@@ -0,0 +1,104 @@
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import bindparam, func, select
+
+from models import User, Post, Tag, PostTag
+
+
+users = User.__table__
+tags = Tag.__table__
+posts = Post.__table__
+posttags = PostTag.__table__
+
+# The cached entries that show post counts. A counter UPDATE names
+# them itself, rather than dropping every namespace cached for its
+# table, and bumps updated_at so the ETags of those pages change too.
+USER_COUNT_PAGES = [('users_page', None)]
+TAG_COUNT_PAGES = [('tags', 'all'), ('tags', 'popular'), ('tags_page', None)]
+
+
+def _adjust(session, table, deltas, invalidates):
+    """Adds deltas[id] to the post_count of each row in one
+       executemany UPDATE."""
+    deltas = [dict(row_id=row_id, delta=delta) for row_id, delta in deltas.items() if delta]
+    if not deltas:
+        return
+    statement = (table.update()
+                 .where(table.c.id == bindparam('row_id'))
+                 .values(post_count=table.c.post_count + bindparam('delta'), updated_at=datetime.utcnow())
+                 .execution_options(invalidates=invalidates))
+    session.execute(statement, deltas)
+
+
+def adjust_user_counts(session, deltas):
+    """deltas maps user ids to the change in their post count."""
+    stale = USER_COUNT_PAGES + [('user_page', str(user_id)) for user_id in deltas]
+    _adjust(session, users, deltas, stale)
+
+
+def adjust_tag_counts(session, deltas):
+    """deltas maps tag ids to the change in their post count."""
+    stale = TAG_COUNT_PAGES + [('tag_page', str(tag_id)) for tag_id in deltas]
+    _adjust(session, tags, deltas, stale)
+
+
+def post_added(session, user_id):
+    adjust_user_counts(session, {user_id: 1})
+
+
+def post_deleted(session, post_id, user_id):
+    """Call before deleting a post, while its posttags
+       rows are still there to say which tags lose it."""
+    tag_ids = [tag_id for (tag_id,) in session.execute(select(posttags.c.tag_id)
+                                                       .where(posttags.c.post_id == post_id))]
+    adjust_user_counts(session, {user_id: -1})
+    adjust_tag_counts(session, {tag_id: -1 for tag_id in tag_ids})
+
+
+def user_deleted(session, user_id):
+    """Call before deleting a user: every tag on the
+       user's posts loses those posts."""
+    rows = session.execute(select(posttags.c.tag_id, func.count())
+                           .join(posts, posts.c.id == posttags.c.post_id)
+                           .where(posts.c.user_id == user_id)
+                           .group_by(posttags.c.tag_id))
+    adjust_tag_counts(session, {tag_id: -n for tag_id, n in rows})
+
+
+def tags_changed(session, added, removed):
+    deltas = Counter({tag_id: 1 for tag_id in added})
+    deltas.subtract({tag_id: 1 for tag_id in removed})
+    adjust_tag_counts(session, deltas)
+
+
+def actual_counts():
+    """Correlated subqueries for the true post counts."""
+    user_posts = (select(func.count()).select_from(posts)
+                  .where(posts.c.user_id == users.c.id).scalar_subquery())
+    tag_posts = (select(func.count()).select_from(posttags)
+                 .where(posttags.c.tag_id == tags.c.id).scalar_subquery())
+    return {users: user_posts, tags: tag_posts}
+
+
+def counter_drift(session):
+    """Rows whose stored post_count is wrong, as
+       {'users': [(id, stored, actual)], 'tags': [...]}."""
+    drift = {}
+    for table, actual in actual_counts().items():
+        rows = session.execute(select(table.c.id, table.c.post_count, actual)
+                               .where(table.c.post_count != actual)
+                               .order_by(table.c.id))
+        drift[table.name] = [tuple(row) for row in rows]
+    return drift
+
+
+def rebuild_counters(session):
+    """Recomputes every stored post_count with one UPDATE
+       per table, touching only the rows that are wrong."""
+    stale = USER_COUNT_PAGES + TAG_COUNT_PAGES + [('user_page', None), ('tag_page', None)]
+    for table, actual in actual_counts().items():
+        session.execute(table.update()
+                        .where(table.c.post_count != actual)
+                        .values(post_count=actual, updated_at=datetime.utcnow())
+                        .execution_options(invalidates=stale))
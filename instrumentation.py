@@ -0,0 +1,294 @@
+import cProfile
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from flask import g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+
+logger = logging.getLogger('blogly.sql')
+
+_PLACEHOLDER_LIST = re.compile(r'\(\s*(?:\?|%s|%\(\w+\)s)(?:\s*,\s*(?:\?|%s|%\(\w+\)s))*\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Reduces a SQL statement to its shape, so two statements
+       that differ only in their bound values (including the
+       length of an expanded IN list) compare equal."""
+    shape = _PLACEHOLDER_LIST.sub('(?)', statement)
+    return _WHITESPACE.sub(' ', shape).strip()
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements[statement_shape(statement)] += 1
+
+
+def init_query_counter(app):
+    """Counts the SQL statements each request runs while
+       the QUERY_COUNTER setting is on.
+
+       The total goes out in an X-Query-Count header. Any
+       statement shape that repeats N_PLUS_ONE_THRESHOLD times
+       or more in one request is the mark of an N+1 pattern;
+       those are logged and counted in X-Repeated-Queries."""
+    app.config.setdefault('QUERY_COUNTER', False)
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', 3)
+
+    if not event.contains(Engine, 'before_cursor_execute', _count_statement):
+        event.listen(Engine, 'before_cursor_execute', _count_statement)
+
+    @app.before_request
+    def start_query_counter():
+        if app.config['QUERY_COUNTER']:
+            g.sql_statements = Counter()
+
+    @app.after_request
+    def report_query_counter(response):
+        statements = g.pop('sql_statements', None)
+        if statements is None:
+            return response
+
+        threshold = app.config['N_PLUS_ONE_THRESHOLD']
+        repeated = {shape: n for shape, n in statements.items() if n >= threshold}
+        response.headers['X-Query-Count'] = str(sum(statements.values()))
+        response.headers['X-Repeated-Queries'] = str(len(repeated))
+        for shape, n in repeated.items():
+            logger.warning('possible N+1 in %s %s: %d x %s', request.method, request.path, n, shape)
+        return response
+
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """A Prometheus histogram with one series per endpoint."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts = defaultdict(lambda: [0] * (len(buckets) + 1))
+        self.sums = Counter()
+
+    def observe(self, endpoint, value):
+        with self.lock:
+            self.counts[endpoint][bisect_left(self.buckets, value)] += 1
+            self.sums[endpoint] += value
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} histogram'
+        with self.lock:
+            series = sorted((endpoint, list(counts), self.sums[endpoint])
+                            for endpoint, counts in self.counts.items())
+        for endpoint, counts, total in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                yield f'{self.name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}'
+            yield f'{self.name}_sum{{endpoint="{endpoint}"}} {total}'
+            yield f'{self.name}_count{{endpoint="{endpoint}"}} {cumulative}'
+
+
+class RequestMetrics:
+    """Per-endpoint histograms of what each request cost."""
+
+    def __init__(self):
+        self.histograms = dict(
+            wall=Histogram('blogly_request_duration_seconds', 'Time to handle a request.', SECONDS_BUCKETS),
+            db=Histogram('blogly_request_db_seconds', 'Time a request spent running SQL.', SECONDS_BUCKETS),
+            queries=Histogram('blogly_request_queries', 'SQL statements a request ran.', QUERY_BUCKETS),
+            template=Histogram('blogly_request_template_seconds', 'Time a request spent rendering templates.',
+                               SECONDS_BUCKETS),
+        )
+
+    def observe(self, endpoint, **values):
+        for name, value in values.items():
+            self.histograms[name].observe(endpoint, value)
+
+    def lines(self):
+        for histogram in self.histograms.values():
+            yield from histogram.lines()
+
+
+def _start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'request_timing' in g:
+        conn.info.setdefault('blogly_query_start', []).append(time.perf_counter())
+
+
+def _stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('blogly_query_start')
+    if starts and has_request_context() and 'request_timing' in g:
+        timing = g.request_timing
+        timing['db'] += time.perf_counter() - starts.pop()
+        timing['queries'] += 1
+
+
+class TimedTemplate(Template):
+    """A Jinja template that adds its render time to the
+       current request's timing. Flask's template_rendered
+       signal would only say when rendering ended, and not
+       at all without blinker installed."""
+
+    def render(self, *args, **kwargs):
+        if not (has_request_context() and 'request_timing' in g):
+            return super().render(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            g.request_timing['template'] += time.perf_counter() - start
+
+
+def init_request_metrics(app):
+    """Records wall time, SQL time, SQL statement count and
+       template render time for every request, as histograms
+       per endpoint in the /metrics output.
+
+       With PROFILING_ENABLED on, a request sent with an
+       X-Profile header also runs under cProfile; its stats are
+       written to PROFILE_DIR (by default under the instance
+       folder, where other local users cannot read or plant
+       files) and the file name is returned in an X-Profile-File
+       header. Load them with pstats."""
+    app.config.setdefault('REQUEST_METRICS', True)
+    app.config.setdefault('PROFILING_ENABLED', False)
+    app.config.setdefault('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+
+    metrics = RequestMetrics()
+    app.extensions['blogly_request_metrics'] = metrics
+    register_metrics(app, metrics.lines)
+    app.jinja_env.template_class = TimedTemplate
+
+    if not event.contains(Engine, 'before_cursor_execute', _start_statement_timer):
+        event.listen(Engine, 'before_cursor_execute', _start_statement_timer)
+        event.listen(Engine, 'after_cursor_execute', _stop_statement_timer)
+
+    @app.before_request
+    def start_request_timer():
+        if app.config['REQUEST_METRICS']:
+            g.request_timing = dict(start=time.perf_counter(), db=0.0, queries=0, template=0.0)
+        if app.config['PROFILING_ENABLED'] and request.headers.get('X-Profile'):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                logger.warning('not profiling %s: another profiler is active', request.path)
+            else:
+                g.profiler = profiler
+
+    @app.after_request
+    def record_request_timer(response):
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(app.config['PROFILE_DIR'], mode=0o700, exist_ok=True)
+            name = f'{request.endpoint or "unknown"}-{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}.prof'
+            profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], name))
+            response.headers['X-Profile-File'] = name
+
+        timing = g.pop('request_timing', None)
+        if timing is not None:
+            metrics.observe(request.endpoint or 'unknown', wall=time.perf_counter() - timing['start'],
+                            db=timing['db'], queries=timing['queries'], template=timing['template'])
+        return response
+
+
+def register_metrics(app, collector):
+    """Adds a collector to the app's /metrics output. A
+       collector is a callable yielding lines of Prometheus
+       text format."""
+    app.extensions.setdefault('blogly_metrics', []).append(collector)
+
+
+def render_metrics(app):
+    """Everything the registered collectors report, as one
+       Prometheus text format document."""
+    lines = []
+    for collector in app.extensions.get('blogly_metrics', []):
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+
+class PoolStats:
+    """Running totals for one connection pool."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that keeps PoolStats: how often connections
+       are checked out, opened and invalidated, and how long
+       callers wait for one."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+        event.listen(self, 'checkout', lambda *args: self.stats.add(checkouts=1))
+        event.listen(self, 'connect', lambda *args: self.stats.add(connects=1))
+        event.listen(self, 'invalidate', lambda *args: self.stats.add(invalidations=1))
+        event.listen(self, 'soft_invalidate', lambda *args: self.stats.add(invalidations=1))
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.stats.add(timeouts=1)
+            raise
+        finally:
+            self.stats.record_wait(time.perf_counter() - start)
+
+
+def pool_metrics(pool):
+    """Gauges and counters for an InstrumentedQueuePool, in
+       Prometheus text format. Other pools report nothing."""
+    stats = getattr(pool, 'stats', None)
+    if stats is None:
+        return
+
+    metrics = [
+        ('gauge', 'blogly_db_pool_size', 'Connections the pool keeps open.', pool.size()),
+        ('gauge', 'blogly_db_pool_checked_out', 'Connections currently in use.', pool.checkedout()),
+        ('gauge', 'blogly_db_pool_overflow', 'Connections open beyond the pool size.', max(pool.overflow(), 0)),
+        ('counter', 'blogly_db_pool_checkouts_total', 'Connections handed out.', stats.checkouts),
+        ('counter', 'blogly_db_pool_connects_total', 'New database connections opened.', stats.connects),
+        ('counter', 'blogly_db_pool_invalidations_total', 'Connections invalidated.', stats.invalidations),
+        ('counter', 'blogly_db_pool_timeouts_total', 'Checkouts that gave up waiting.', stats.timeouts),
+        ('counter', 'blogly_db_pool_wait_seconds_total', 'Time spent waiting for a connection.', stats.wait_seconds),
+        ('gauge', 'blogly_db_pool_max_wait_seconds', 'Longest wait for a connection.', stats.max_wait_seconds),
+    ]
+    for kind, name, help_text, value in metrics:
+        yield f'# HELP {name} {help_text}'
+        yield f'# TYPE {name} {kind}'
+        yield f'{name} {value}'
@@ -1,25 +1,82 @@
+import sqlite3
+from datetime import datetime
 from enum import unique
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import backref
 
+from instrumentation import InstrumentedQueuePool
+from replicas import RoutingSQLAlchemy
+from search import install_search_index
+
+
+db = RoutingSQLAlchemy()
+
+# Users without a picture of their own get this URL. The avatar
+# endpoint serves a bundled image in its place.
+DEFAULT_IMAGE_URL = 'https://cdn5.vectorstock.com/i/thumb-large/66/14/default-avatar-photo-placeholder-profile-picture-vector-21806614.jpg'
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores foreign keys, and so ON DELETE CASCADE,
+       unless they are switched on for every connection."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+def pool_options(uri, size=5, max_overflow=10, timeout=30, recycle=1800, pre_ping=True):
+    """Engine options for a pooled, instrumented connection pool.
+
+       In-memory SQLite databases live inside a single connection,
+       so they keep the pool Flask-SQLAlchemy picks for them. A
+       file-based SQLite database may be used from several threads
+       once pooled, which is safe as each connection is only ever
+       held by one thread at a time."""
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+
+    options = dict(poolclass=InstrumentedQueuePool, pool_size=size, max_overflow=max_overflow,
+                   pool_timeout=timeout, pool_recycle=recycle, pool_pre_ping=pre_ping)
+    if url.get_backend_name() == 'sqlite':
+        options['connect_args'] = {'check_same_thread': False}
+    return options
 
-db = SQLAlchemy()
 
 def connect_db(app):
-    db.app = app
+    """Registers the database with `app`. The engine, and so
+       the first connection, is only made when a request or
+       command first uses it."""
     db.init_app(app)
 
 
+# User and Post rows carry a version that every UPDATE bumps, so an
+# edit made from an out-of-date copy is refused instead of silently
+# overwriting a newer one. Deleting a row someone else has already
+# deleted is still allowed, as it was before versions.
 class User(db.Model):
 
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('ix_users_last_first_id', 'last_name', 'first_name', 'id'),
+        db.Index('ix_users_post_count_id', 'post_count', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     first_name = db.Column(db.String(50), nullable=False)
     last_name = db.Column(db.String(50), nullable=False)
-    image_url = db.Column(db.String, default='https://cdn5.vectorstock.com/i/thumb-large/66/14/default-avatar-photo-placeholder-profile-picture-vector-21806614.jpg')
+    image_url = db.Column(db.String, default=DEFAULT_IMAGE_URL)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                           server_default=db.func.now())
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    posts = db.relationship('Post', cascade='all, delete', passive_deletes=True)
 
-    posts = db.relationship('Post')
+    __mapper_args__ = {'version_id_col': version, 'confirm_deleted_rows': False}
 
     
     def __repr__(self) -> str:
@@ -35,22 +92,41 @@ class Post(db.Model):
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                           server_default=db.func.now())
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     users = db.relationship('User')
 
+    __mapper_args__ = {'version_id_col': version, 'confirm_deleted_rows': False}
+
     def __repr__(self) -> str:
         return f'{self.__class__.__name__}(id={self.id}, title={self.title}, created_at={self.created_at}, users={self.users}'
 
 
+# Newest-first listings: the feed, and one user's posts. id breaks
+# ties between posts created at the same moment.
+db.Index('ix_posts_created_id', Post.created_at.desc(), Post.id.desc())
+db.Index('ix_posts_user_created_id', Post.user_id, Post.created_at.desc(), Post.id.desc())
+
+install_search_index(Post.__table__)
+
+
 class Tag(db.Model):
 
     __tablename__ = 'tags'
+    __table_args__ = (
+        db.Index('ix_tags_post_count_id', 'post_count', 'id'),
+    )
     
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     name = db.Column(db.String, unique=True, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                           server_default=db.func.now())
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     posts = db.relationship('Post', secondary='posttags', backref='tags')
-    join_tags = db.relationship('PostTag', cascade="all, delete, delete-orphan", backref='all_tags')
+    join_tags = db.relationship('PostTag', cascade="all, delete, delete-orphan", passive_deletes=True, backref='all_tags')
 
 
 class PostTag(db.Model):
@@ -0,0 +1,97 @@
+import hashlib
+from datetime import datetime
+
+from flask import Response, request, stream_with_context
+
+
+def last_modified_of(version):
+    """The newest timestamp in a validator tuple, if any."""
+    stamps = [value for value in version if isinstance(value, datetime)]
+    return max(stamps) if stamps else None
+
+
+def etag_of(namespace, key, version):
+    digest = hashlib.sha1(repr((namespace, key, version)).encode()).hexdigest()
+    return digest[:20]
+
+
+def page_response(etag, last_modified, html=''):
+    response = Response(html, content_type='text/html; charset=utf-8')
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditional_page(cache, namespace, key, validator, render):
+    """Serves a read-only page with conditional GET support.
+
+       Rendered HTML is kept in `cache` together with its ETag and
+       Last-Modified, so a hit is answered without touching the
+       database or the template engine. On a miss, `validator`
+       returns a tuple that changes whenever the page would (the
+       updated_at stamps and counts of the rows it shows), or None
+       when the entity does not exist. The client gets a 304 if
+       its copy is still current; otherwise `render` builds the
+       page, which is cached until a write invalidates it. The
+       cache slot is resolved before the validator runs, so a
+       page rendered from rows a concurrent write has since
+       changed is never stored where later requests look. The
+       validator and render run in cache.loading(), so what is
+       cached comes from the primary database.
+
+       Returns None when the validator reports a missing entity."""
+    slot = cache.slot(namespace, key)
+    entry = cache.lookup(namespace, slot)
+    if entry is None:
+        with cache.loading():
+            version = validator()
+            if version is None:
+                return None
+            etag, last_modified = etag_of(namespace, key, version), last_modified_of(version)
+            response = page_response(etag, last_modified).make_conditional(request)
+            if response.status_code == 304:
+                return response
+
+            entry = (etag, last_modified, render())
+        cache.store(slot, entry)
+
+    etag, last_modified, html = entry
+    return page_response(etag, last_modified, html).make_conditional(request)
+
+
+def streamed_page(cache, namespace, key, validator, generate, max_cached_bytes):
+    """Like conditional_page, for pages too long to build in
+       memory. On a miss `generate` returns the page as an
+       iterable of chunks, which is sent as it is produced. The
+       chunks are kept as they go by, and a page that is complete
+       and no larger than `max_cached_bytes` is then cached, to be
+       served whole like any other cached page."""
+    slot = cache.slot(namespace, key)
+    entry = cache.lookup(namespace, slot)
+    if entry is None:
+        with cache.loading():
+            version = validator()
+        if version is None:
+            return None
+        etag, last_modified = etag_of(namespace, key, version), last_modified_of(version)
+        response = page_response(etag, last_modified).make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+        def tee():
+            kept, size = [], 0
+            with cache.loading():
+                for chunk in generate():
+                    size += len(chunk)
+                    if size <= max_cached_bytes:
+                        kept.append(chunk)
+                    yield chunk
+            if size <= max_cached_bytes:
+                cache.store(slot, (etag, last_modified, ''.join(kept)))
+
+        return page_response(etag, last_modified, stream_with_context(tee()))
+
+    etag, last_modified, html = entry
+    return page_response(etag, last_modified, html).make_conditional(request)
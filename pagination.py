@@ -0,0 +1,107 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    raise TypeError(f'cannot put {type(value).__name__} in a cursor')
+
+
+def _decode_value(obj):
+    if set(obj) == {'dt'}:
+        return datetime.fromisoformat(obj['dt'])
+    return obj
+
+
+def encode_cursor(values):
+    """Packs the sort key of a row into an opaque,
+       url-safe cursor string. Datetimes in the key
+       come back out of decode_cursor as datetimes."""
+    raw = json.dumps(list(values), separators=(',', ':'), default=_encode_value).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Unpacks a cursor made by encode_cursor for a key over
+       `columns`. Anything that is missing or malformed, or
+       whose values are not of their columns' types, comes back
+       as None, which callers treat as 'start from the first
+       page'."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw, object_hook=_decode_value)
+    except (binascii.Error, ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != len(columns):
+        return None
+    for value, column in zip(values, columns):
+        if type(value) is not column.type.python_type:
+            return None
+    return values
+
+
+def keyset_filter(query, columns, limit, after=None, before=None, descending=False):
+    """Applies the seek condition, ordering and limit of one
+       keyset page to `query`, which may be an ORM Query or a
+       select(). Rows come back from it in query order; pass
+       them to keyset_result to get the page."""
+    key = tuple_(*columns)
+    forward = before is None
+    bound = after if forward else before
+
+    if bound is not None:
+        if forward != descending:
+            query = query.filter(key > tuple_(*bound))
+        else:
+            query = query.filter(key < tuple_(*bound))
+
+    if forward != descending:
+        query = query.order_by(*columns)
+    else:
+        query = query.order_by(*[column.desc() for column in columns])
+    return query.limit(limit + 1)
+
+
+def keyset_result(rows, columns, limit, after=None, before=None):
+    """Turns the rows fetched by a keyset_filter query into
+       (rows, next_cursor, prev_cursor); a cursor is None when
+       there is no page in that direction."""
+    forward = before is None
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    if not forward:
+        rows.reverse()
+
+    def cursor_for(row):
+        return encode_cursor(getattr(row, column.key) for column in columns)
+
+    if forward:
+        has_next, has_prev = has_more, after is not None
+    else:
+        has_next, has_prev = True, has_more
+
+    next_cursor = cursor_for(rows[-1]) if rows and has_next else None
+    prev_cursor = cursor_for(rows[0]) if rows and has_prev else None
+    return rows, next_cursor, prev_cursor
+
+
+def keyset_page(query, columns, limit, after=None, before=None, descending=False):
+    """Runs one page of a keyset (seek) paginated query.
+
+       Rows are ordered by `columns`, which must end in a unique
+       column so the order is total. Instead of an OFFSET, the
+       page starts right after (or right before) the sort key in
+       the cursor, so a deep page costs the same as the first one
+       as long as an index covers `columns`.
+
+       Returns (rows, next_cursor, prev_cursor); a cursor is None
+       when there is no page in that direction."""
+    rows = keyset_filter(query, columns, limit, after, before, descending).all()
+    return keyset_result(rows, columns, limit, after, before)
@@ -0,0 +1,84 @@
+import time
+from contextlib import contextmanager
+
+from flask import request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+
+
+REPLICA = 'replica'
+STICKY_COOKIE = 'blogly_primary'
+
+
+def replica_reads(view):
+    """Marks a view whose GET requests only read, so they may
+       be served from the replica."""
+    view.replica_reads = True
+    return view
+
+
+@contextmanager
+def primary_reads(session):
+    """Sends the reads `session` makes inside the block to the
+       primary, then puts the replica choice back as it was."""
+    previous = session.info.get('use_replica')
+    session.info['use_replica'] = False
+    try:
+        yield
+    finally:
+        if previous is not None and not session.info.get('wrote'):
+            session.info['use_replica'] = previous
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the replica while its
+       'use_replica' info flag is set, and otherwise goes to
+       the primary. Flushes and INSERT/UPDATE/DELETE statements
+       always go to the primary; the first of them also clears
+       the flag, so the rest of the request reads what it wrote,
+       and sets 'wrote' so the client sticks to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or (clause is not None and clause.is_dml):
+            self.info['wrote'] = True
+            self.info['use_replica'] = False
+        elif self.info.get('use_replica'):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_replica_routing(app, db):
+    """Sends the reads of marked views to the replica bind, when
+       SQLALCHEMY_BINDS has one.
+
+       A client that has just written reads from the primary for
+       REPLICA_STICKY_SECONDS afterwards, by way of a cookie, so
+       it sees its own changes however far the replica lags."""
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+    if REPLICA not in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        return
+
+    @app.before_request
+    def choose_database():
+        view = app.view_functions.get(request.endpoint)
+        db.session.info['wrote'] = False
+        db.session.info['use_replica'] = (request.method in ('GET', 'HEAD')
+                                          and getattr(view, 'replica_reads', False)
+                                          and STICKY_COOKIE not in request.cookies)
+
+    @app.after_request
+    def stick_to_primary(response):
+        if db.session.info.get('wrote'):
+            seconds = app.config['REPLICA_STICKY_SECONDS']
+            response.set_cookie(STICKY_COOKIE, str(int(time.time() + seconds)), max_age=seconds, httponly=True)
+        return response
+
+    @app.teardown_request
+    def reset_database_choice(exc):
+        db.session.info.pop('use_replica', None)
+        db.session.info.pop('wrote', None)
@@ -0,0 +1,129 @@
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, event, text
+
+
+# Highlight markers put around matched words by ts_headline() and
+# snippet(). They contain nothing HTML escaping touches, so they survive
+# escaping the snippet and are only then turned into <mark> tags.
+MARK_START = '[[['
+MARK_END = ']]]'
+
+POSTGRES_DDL = [
+    """ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+           setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+           setweight(to_tsvector('english', coalesce(content, '')), 'B')
+       ) STORED""",
+    'CREATE INDEX IF NOT EXISTS ix_posts_search_vector ON posts USING GIN (search_vector)',
+]
+
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts
+       USING fts5(title, content, content='posts', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+           INSERT INTO posts_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+           INSERT INTO posts_fts(posts_fts, rowid, title, content)
+           VALUES ('delete', old.id, old.title, old.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF title, content ON posts BEGIN
+           INSERT INTO posts_fts(posts_fts, rowid, title, content)
+           VALUES ('delete', old.id, old.title, old.content);
+           INSERT INTO posts_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+       END""",
+]
+
+SEARCH_DDL = {'postgresql': POSTGRES_DDL, 'sqlite': SQLITE_DDL}
+
+POSTGRES_SEARCH = text(f"""
+    SELECT p.id, p.title, ts_rank_cd(p.search_vector, q) AS rank,
+           ts_headline('english', p.content, q,
+                       'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords=30, MinWords=10') AS snippet
+    FROM posts p, websearch_to_tsquery('english', :terms) q
+    WHERE p.search_vector @@ q
+    ORDER BY rank DESC, p.id DESC
+    LIMIT :limit OFFSET :offset
+""")
+
+SQLITE_SEARCH = text(f"""
+    SELECT p.id, p.title, bm25(posts_fts, 10.0, 1.0) AS rank,
+           snippet(posts_fts, 1, '{MARK_START}', '{MARK_END}', '...', 24) AS snippet
+    FROM posts_fts JOIN posts p ON p.id = posts_fts.rowid
+    WHERE posts_fts MATCH :terms
+    ORDER BY rank, p.id DESC
+    LIMIT :limit OFFSET :offset
+""")
+
+
+class SearchUnavailable(Exception):
+    """The database has no full-text search Blogly can use."""
+
+
+def install_search_index(posts):
+    """Creates the full-text index along with the posts table.
+
+       On Postgres that is a generated tsvector column (title
+       weighted above content) with a GIN index over it. On
+       SQLite it is an external-content FTS5 table, kept in step
+       with posts by triggers."""
+    for statement in POSTGRES_DDL:
+        event.listen(posts, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+    for statement in SQLITE_DDL:
+        event.listen(posts, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    event.listen(posts, 'before_drop', DDL('DROP TABLE IF EXISTS posts_fts').execute_if(dialect='sqlite'))
+
+
+def rebuild_search_index(session):
+    """Re-indexes every post. Only SQLite needs this, for posts
+       written before the index existed; the Postgres column is
+       computed by the database itself."""
+    if session.bind.dialect.name == 'sqlite':
+        session.execute(text("INSERT INTO posts_fts(posts_fts) VALUES ('rebuild')"))
+
+
+def create_search_index(session):
+    """Adds the full-text index to a posts table created before
+       it existed, then indexes the posts already there. Every
+       statement is a no-op when its part of the index exists."""
+    dialect = session.bind.dialect.name
+    if dialect not in SEARCH_DDL:
+        raise SearchUnavailable(f'full-text search is not set up for {dialect}')
+    for statement in SEARCH_DDL[dialect]:
+        session.execute(text(statement))
+    rebuild_search_index(session)
+
+
+def fts5_query(terms):
+    """Quotes each word so FTS5 matches them all literally
+       instead of parsing the user's input as query syntax."""
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in terms.split())
+
+
+def highlight(snippet):
+    html = str(escape(snippet or ''))
+    return Markup(html.replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def search_posts(session, terms, page=1, per_page=20):
+    """Ranked full-text search over post titles and content.
+
+       Returns (results, has_next), where each result is a dict
+       with the post's id, title and a highlighted snippet. Raises
+       SearchUnavailable on databases other than Postgres and
+       SQLite."""
+    terms = terms.strip()
+    if not terms:
+        return [], False
+
+    dialect = session.bind.dialect.name
+    if dialect == 'postgresql':
+        statement = POSTGRES_SEARCH
+    elif dialect == 'sqlite':
+        statement, terms = SQLITE_SEARCH, fts5_query(terms)
+    else:
+        raise SearchUnavailable(f'full-text search is not set up for {dialect}')
+
+    rows = session.execute(statement, dict(terms=terms, limit=per_page + 1,
+                                           offset=(page - 1) * per_page)).all()
+    results = [dict(id=row.id, title=row.title, snippet=highlight(row.snippet)) for row in rows[:per_page]]
+    return results, len(rows) > per_page
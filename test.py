@@ -1,26 +1,49 @@
-from unittest import TestCase
+import asyncio
+import base64
+import json
+import os
+import pstats
+import re
+import shutil
+import tempfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from importlib.util import find_spec
+from threading import Thread
+from unittest import TestCase, mock, skipUnless
 from datetime import datetime
 
 from decouple import config
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
 from werkzeug.wrappers import request
 
-from app import app
-from models import User, Post, Tag, db
+from app import create_app, make_cache_backend
+from avatars import AvatarError, fetch_image
+from cli import Importer
+from cache import MISSING, LRUCache, SharedCache, LocalSharedClient, Cache
+from models import User, Post, Tag, PostTag, db
+from pagination import encode_cursor
+from search import SearchUnavailable
 
-app.config['SQLALCHEMY_DATABASE_URI'] = config('TEST_DB')
-app.config['SQLALCHEMY_ECHO'] = False
+app = create_app({'SQLALCHEMY_DATABASE_URI': config('TEST_DB')})
 
-db.drop_all()
-db.create_all()
+
+def setUpModule():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
 
 
 class BloglyTestCase(TestCase):
     def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
         User.query.delete()
     
 
     def tearDown(self) -> None:
         db.session.rollback()
+        self.context.pop()
     
 
     def make_user(self):
@@ -52,6 +75,72 @@ class BloglyTestCase(TestCase):
             self.assertEqual(new_resp.status_code, 200)
     
 
+    def test_pages_cache_in_a_shared_backend(self):
+        client = LocalSharedClient()
+        with self.assertRaises(ValueError):
+            client.set('feed_page:([datetime.datetime(2021, 7, 28, 7, 40), 9], None)', 1)
+        user = self.make_user()
+        db.session.add(User(first_name='Long' * 80, last_name='Name' * 80))
+        db.session.add(Post(title='Shared', content='c', created_at=datetime(2021, 7, 28, 7, 40), user_id=user.id))
+        db.session.commit()
+        cache = app.extensions['blogly_cache']
+        shared = app.extensions['blogly_cache'] = Cache(SharedCache(client))
+        app.config['USERS_PER_PAGE'] = 1
+        try:
+            with app.test_client() as web:
+                for page in ('/users', '/posts'):
+                    html = web.get(page).get_data(as_text=True)
+                    for link in re.findall(r'href="(/(?:users|posts)\?after=[^"]+)"', html):
+                        self.assertEqual(web.get(link).status_code, 200)
+                        self.assertEqual(web.get(link).status_code, 200)
+            self.assertGreater(shared.hits['users_page'], 0)
+        finally:
+            app.extensions['blogly_cache'] = cache
+            app.config['USERS_PER_PAGE'] = 50
+
+
+    def test_users_pagination(self):
+        for first, last in [('Ann', 'Able'), ('Bob', 'Baker'), ('Cat', 'Cole')]:
+            db.session.add(User(first_name=first, last_name=last))
+        db.session.commit()
+        app.config['USERS_PER_PAGE'] = 2
+        try:
+            with app.test_client() as client:
+                resp = client.get('/users')
+                html = resp.get_data(as_text=True)
+                self.assertIn('Able, Ann', html)
+                self.assertIn('Baker, Bob', html)
+                self.assertNotIn('Cole, Cat', html)
+                next_link = re.search(r'href="(/users\?after=[^"]+)"', html).group(1)
+
+                resp = client.get(next_link)
+                html = resp.get_data(as_text=True)
+                self.assertIn('Cole, Cat', html)
+                self.assertNotIn('Able, Ann', html)
+                self.assertNotIn('?after=', html)
+                prev_link = re.search(r'href="(/users\?before=[^"]+)"', html).group(1)
+
+                resp = client.get(prev_link)
+                html = resp.get_data(as_text=True)
+                self.assertIn('Able, Ann', html)
+                self.assertIn('Baker, Bob', html)
+                self.assertNotIn('Cole, Cat', html)
+
+                for values in ([[1], [2], [3]], [{'a': 1}, 'x', 1], ['Able', 'Ann', 'x'], ['Able', 'Ann', True]):
+                    cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+                    resp = client.get(f'/users?after={cursor}')
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn('Able, Ann', resp.get_data(as_text=True))
+
+                etag = client.get('/users').headers['ETag']
+                self.assertEqual(client.get('/users', headers={'If-None-Match': etag}).status_code, 304)
+                User.query.filter_by(first_name='Ann').update({'first_name': 'Anne'})
+                db.session.commit()
+                self.assertEqual(client.get('/users', headers={'If-None-Match': etag}).status_code, 200)
+        finally:
+            app.config['USERS_PER_PAGE'] = 50
+
+
     def test_profile_pages(self):
         with app.test_client() as client:
             user = self.make_user()
@@ -76,7 +165,8 @@ class BloglyTestCase(TestCase):
 
             resp = client.post(f'/users/{user.id}/edit', data=data, follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
-            self.assertIn(f'<li><a href="/users/{user.id}">Ramirez, Marcelo</a></li>', resp.get_data(as_text=True))
+            self.assertIn(f'<li><a href="/users/{user.id}">Ramirez, Marcelo</a> <span class="count">(0 posts)</span></li>',
+                          resp.get_data(as_text=True))
         self.delete_user(user)
             
 
@@ -91,6 +181,24 @@ class BloglyTestCase(TestCase):
         self.delete_user(user)
     
 
+    def test_delete_profile_cascades(self):
+        user = self.make_user()
+        tag = Tag(name='cascade')
+        db.session.add(tag)
+        db.session.add_all(Post(title='p', content='c', created_at=datetime.now(), user_id=user.id, tags=[tag])
+                           for _ in range(3))
+        db.session.commit()
+        tag_id = tag.id
+        with app.test_client() as client:
+            resp = client.get(f'/users/{user.id}/delete')
+            self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Post.query.count(), 0)
+        self.assertEqual(PostTag.query.count(), 0)
+        self.assertEqual(Tag.query.filter_by(name='cascade').count(), 1)
+        db.session.delete(Tag.query.get(tag_id))
+        db.session.commit()
+    
+
     def test_add_profile(self):
         user = self.make_user()
         data = {
@@ -119,6 +227,58 @@ class BloglyTestCase(TestCase):
         self.delete_user(user)
     
 
+    def count_post_creation(self, client, user_id, tag_names):
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            data = dict(title='counted', content='counted', tag=tag_names)
+            resp = client.post(f'/users/{user_id}/posts/new', data=data)
+            self.assertEqual(resp.status_code, 302)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        return len(statements)
+
+
+    def test_add_post_query_count_is_constant(self):
+        with app.test_client() as client:
+            user = self.make_user()
+            db.session.add_all([Tag(name='one'), Tag(name='two')])
+            db.session.commit()
+            first = self.count_post_creation(client, user.id, ['one', 'two'])
+            for _ in range(25):
+                self.make_post(user.id)
+            later = self.count_post_creation(client, user.id, ['one', 'two'])
+            self.assertEqual(first, later)
+            self.assertEqual(Post.query.filter_by(title='counted').count(), 2)
+        Tag.query.filter(Tag.name.in_(['one', 'two'])).delete(synchronize_session=False)
+        db.session.commit()
+
+
+    def test_relationship_pages_have_no_n_plus_one(self):
+        user = self.make_user()
+        tags = [Tag(name=f'n1-{i}') for i in range(3)]
+        db.session.add_all(tags)
+        posts = [Post(title=f'post {i}', content='c', created_at=datetime.now(), user_id=user.id, tags=tags)
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        app.config['QUERY_COUNTER'] = True
+        try:
+            with app.test_client() as client:
+                for url in [f'/users/{user.id}', f'/posts/{posts[0].id}', f'/tags/{tags[0].id}']:
+                    resp = client.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertEqual(resp.headers['X-Repeated-Queries'], '0')
+                    self.assertLessEqual(int(resp.headers['X-Query-Count']), 3)
+        finally:
+            app.config['QUERY_COUNTER'] = False
+        Tag.query.filter(Tag.name.in_(['n1-0', 'n1-1', 'n1-2'])).delete(synchronize_session=False)
+        db.session.commit()
+
+
     def test_show_posts(self):
         with app.test_client() as client:
             user = self.make_user()
@@ -127,8 +287,8 @@ class BloglyTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             resp2 = client.get(f'/posts/{401}')
             self.assertEqual(resp2.status_code, 302)
-        self.delete_user(user)
         self.delete_post(post)
+        self.delete_user(user)
     
     
     def test_edit_post(self):
@@ -142,6 +302,84 @@ class BloglyTestCase(TestCase):
         self.delete_user(user)
     
 
+    def test_concurrent_edits_are_not_lost(self):
+        user = self.make_user()
+        post = self.make_post(user.id)
+        user_id, post_id = user.id, post.id
+        saved, conflicts = [], []
+
+        def editor(n):
+            client = app.test_client()
+            for i in range(5):
+                while True:
+                    form = client.get(f'/posts/{post_id}/edit').get_data(as_text=True)
+                    version = re.search(r'name="version" value="(\d+)"', form).group(1)
+                    resp = client.post(f'/posts/{post_id}/edit', data=dict(title=f'{n}-{i}', content='', version=version))
+                    if resp.status_code != 409:
+                        self.assertEqual(resp.status_code, 302)
+                        saved.append(f'{n}-{i}')
+                        break
+                    conflicts.append(n)
+
+        threads = [Thread(target=editor, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        db.session.expire_all()
+        post = Post.query.get(post_id)
+        self.assertEqual(len(saved), 40)
+        self.assertEqual(post.version, 1 + len(saved))
+        self.assertIn(post.title, saved)
+
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with app.test_client() as client:
+                resp = client.post(f'/users/{user_id}/edit', data=dict(first_name='Ana', version=1))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('WHERE users.id = ? AND users.version = ?', statements[0])
+        with app.test_client() as client:
+            resp = client.post(f'/users/{user_id}/edit', data=dict(first_name='Bea', version=1))
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(User.query.get(user_id).first_name, 'Ana')
+        with app.test_client() as client:
+            resp = client.post(f'/users/{user_id}/edit', data=dict(first_name='Cy', version='abc'))
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(User.query.get(user_id).first_name, 'Ana')
+
+
+    def test_edit_post_syncs_tags(self):
+        with app.test_client() as client:
+            user = self.make_user()
+            post = self.make_post(user.id)
+            db.session.add_all([Tag(name='red'), Tag(name='blue')])
+            db.session.commit()
+            data = dict(title='', content='', tag=['red', 'blue'])
+            client.post(f'/posts/{post.id}/edit', data=data)
+            tags = Post.query.get(post.id).tags
+            self.assertEqual(sorted(tag.name for tag in tags), ['blue', 'red'])
+
+            statements = []
+            record = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(Engine, 'before_cursor_execute', record)
+            try:
+                data = dict(title='', content='', tag=['blue'])
+                client.post(f'/posts/{post.id}/edit', data=data)
+            finally:
+                event.remove(Engine, 'before_cursor_execute', record)
+            tags = Post.query.get(post.id).tags
+            self.assertEqual([tag.name for tag in tags], ['blue'])
+            self.assertEqual(len([s for s in statements if s.lstrip().startswith('UPDATE posts')]), 1)
+        Tag.query.filter(Tag.name.in_(['red', 'blue'])).delete(synchronize_session=False)
+        db.session.commit()
+
+
     def test_delete_post(self):
         with app.test_client() as client:
             user = self.make_user()
@@ -181,10 +419,10 @@ class BloglyTestCase(TestCase):
             newtag = Tag(name='yeah!')
             db.session.add(newtag)
             db.session.commit()
-            tag = Tag.query.first()
+            tag_id = Tag.query.filter_by(name='yeah!').first().id
             data = {'changedtag': 'uhuhuh'}
-            resp = client.post(f'/tags/{tag.id}/edit', data=data, follow_redirects=True)
-            tag = Tag.query.all()[-1]
+            resp = client.post(f'/tags/{tag_id}/edit', data=data, follow_redirects=True)
+            tag = Tag.query.get(tag_id)
             self.assertEqual(resp.status_code, 200)
             self.assertIn(tag.name, resp.get_data(as_text=True))
             db.session.delete(tag)
@@ -206,8 +444,570 @@ class BloglyTestCase(TestCase):
             self.assertNotEqual(tag.name, 'sure')
     
 
+    def test_tag_page_is_streamed(self):
+        user = self.make_user()
+        tag = Tag(name='streamed')
+        db.session.add(tag)
+        db.session.commit()
+        tag_id = tag.id
+        now = datetime.now()
+        db.session.execute(Post.__table__.insert(), [dict(title=f'streamed {n}', content='c', created_at=now,
+                                                          user_id=user.id) for n in range(150)])
+        post_ids = [post_id for (post_id,) in db.session.query(Post.id).filter_by(user_id=user.id)]
+        db.session.execute(PostTag.__table__.insert(), [dict(post_id=post_id, tag_id=tag_id) for post_id in post_ids])
+        db.session.commit()
+
+        cache = app.extensions['blogly_cache']
+        with app.test_client() as client:
+            first = client.get(f'/tags/{tag_id}')
+            self.assertNotIn('Content-Length', first.headers)
+            html = first.get_data(as_text=True)
+            self.assertEqual(len(re.findall(r'<li><a href="/posts/\d+">streamed \d+</a></li>', html)), 150)
+            hits = cache.hits['tag_page']
+            second = client.get(f'/tags/{tag_id}')
+            self.assertIn('Content-Length', second.headers)
+            self.assertEqual(second.get_data(as_text=True), html)
+            self.assertEqual(cache.hits['tag_page'], hits + 1)
+
+            app.config['STREAMED_PAGE_CACHE_BYTES'] = 1000
+            try:
+                cache.invalidate('tag_page')
+                client.get(f'/tags/{tag_id}').get_data()
+                self.assertNotIn('Content-Length', client.get(f'/tags/{tag_id}').headers)
+            finally:
+                app.config['STREAMED_PAGE_CACHE_BYTES'] = 256 * 1024
+        Tag.query.filter_by(id=tag_id).delete(synchronize_session=False)
+        db.session.commit()
+
+
+    def test_compile_templates(self):
+        self.assertEqual(os.path.dirname(app.config['JINJA_BYTECODE_CACHE_DIR']), app.instance_path)
+        directory = tempfile.mkdtemp()
+        try:
+            compiled = create_app({'SQLALCHEMY_DATABASE_URI': config('TEST_DB'), 'JINJA_BYTECODE_CACHE_DIR': directory})
+            result = compiled.test_cli_runner(mix_stderr=False).invoke(args=['blogly', 'compile-templates'])
+            self.assertEqual(result.exit_code, 0)
+            templates = compiled.jinja_env.list_templates(extensions=['html'])
+            self.assertEqual(len(os.listdir(directory)), len(templates))
+        finally:
+            shutil.rmtree(directory)
+
+
     def test_404_route(self):
         with app.test_client() as client:
             resp = client.get('/404')
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Sorry', resp.get_data(as_text=True))
+
+
+    def test_tag_cache_is_invalidated_on_write(self):
+        cache = app.extensions['blogly_cache']
+        with app.test_client() as client:
+            client.post('/tags/new', data=dict(newtag='cached'))
+            tag = Tag.query.filter_by(name='cached').first()
+            self.assertIn('cached', client.get('/tags').get_data(as_text=True))
+            hits = cache.hits['tags_page']
+            self.assertIn('cached', client.get('/tags').get_data(as_text=True))
+            self.assertEqual(cache.hits['tags_page'], hits + 1)
+
+            client.post(f'/tags/{tag.id}/edit', data={'changedtag': 'renamed'})
+            html = client.get('/tags').get_data(as_text=True)
+            self.assertIn('renamed', html)
+            self.assertNotIn('cached', html)
+            self.assertIn('blogly_cache_hits_total{namespace="tags_page"}', client.get('/metrics').get_data(as_text=True))
+            client.get(f'/tags/{tag.id}/delete')
+            self.assertNotIn('renamed', client.get('/tags').get_data(as_text=True))
+
+
+    def test_conditional_get_on_post_page(self):
+        with app.test_client() as client:
+            user = self.make_user()
+            post = self.make_post(user.id)
+            post_id = post.id
+            resp = client.get(f'/posts/{post_id}')
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Last-Modified', resp.headers)
+
+            resp = client.get(f'/posts/{post_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            client.post(f'/posts/{post_id}/edit', data=dict(title='changed', content=''))
+            resp = client.get(f'/posts/{post_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            self.assertIn('changed', resp.get_data(as_text=True))
+
+            etag = resp.headers['ETag']
+            db.session.add(Tag(name='late'))
+            db.session.commit()
+            client.post(f'/posts/{post_id}/edit', data=dict(title='', content='', tag='late'))
+            resp = client.get(f'/posts/{post_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('late', resp.get_data(as_text=True))
+        Tag.query.filter(Tag.name.in_(['late'])).delete(synchronize_session=False)
+        db.session.commit()
+
+
+    def test_search_posts(self):
+        user = self.make_user()
+        db.session.add_all([
+            Post(title='Sourdough basics', content='Feed the starter <daily> before baking bread.',
+                 created_at=datetime.now(), user_id=user.id),
+            Post(title='Bread', content='Bread, bread and more bread.', created_at=datetime.now(), user_id=user.id),
+            Post(title='Gardening', content='Tomatoes need sun.', created_at=datetime.now(), user_id=user.id),
+        ])
+        db.session.commit()
+        user_id = user.id
+        for trigger in ('insert', 'delete', 'update'):
+            db.session.execute(text(f'DROP TRIGGER posts_fts_{trigger}'))
+        db.session.execute(text('DROP TABLE posts_fts'))
+        db.session.commit()
+        result = app.test_cli_runner(mix_stderr=False).invoke(args=['blogly', 'search-index'])
+        self.assertEqual(result.exit_code, 0)
+        with app.test_client() as client:
+            with mock.patch('app.search_posts', side_effect=SearchUnavailable('not here')):
+                resp = client.get('/search?q=bread')
+            self.assertEqual(resp.status_code, 501)
+            self.assertIn('not available', resp.get_data(as_text=True))
+            html = client.get('/search?q=bread').get_data(as_text=True)
+            self.assertIn('<mark>bread</mark>', html.lower())
+            self.assertLess(html.index('>Bread</a>'), html.index('>Sourdough basics</a>'))
+            self.assertNotIn('Gardening', html)
+            self.assertIn('&lt;daily&gt;', client.get('/search?q=starter').get_data(as_text=True))
+
+            client.get(f'/users/{user_id}/delete')
+            self.assertIn('No posts matched', client.get('/search?q=bread').get_data(as_text=True))
+
+
+    def test_upgrade_db_brings_an_old_schema_up_to_date(self):
+        with tempfile.TemporaryDirectory() as directory:
+            uri = f"sqlite:///{os.path.join(directory, 'old.db')}"
+            old = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+            with old.app_context():
+                db.session.remove()
+                for statement in [
+                        'CREATE TABLE users (id INTEGER PRIMARY KEY, first_name VARCHAR(50) NOT NULL, '
+                        'last_name VARCHAR(50) NOT NULL, image_url VARCHAR)',
+                        'CREATE TABLE posts (id INTEGER PRIMARY KEY, title VARCHAR(100) NOT NULL, content TEXT NOT NULL, '
+                        'created_at DATETIME NOT NULL, user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE)',
+                        'CREATE TABLE tags (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL UNIQUE)',
+                        'CREATE TABLE posttags (post_id INTEGER REFERENCES posts (id) ON DELETE CASCADE, '
+                        'tag_id INTEGER REFERENCES tags (id) ON DELETE CASCADE, PRIMARY KEY (post_id, tag_id))',
+                        "INSERT INTO users VALUES (1, 'Old', 'Timer', NULL)",
+                        "INSERT INTO posts VALUES (1, 'Before', 'Written long ago.', '2021-07-01 09:00:00', 1)",
+                        "INSERT INTO tags VALUES (1, 'vintage')",
+                        'INSERT INTO posttags VALUES (1, 1)']:
+                    db.session.execute(text(statement))
+                db.session.commit()
+
+            runner = old.test_cli_runner(mix_stderr=False)
+            result = runner.invoke(args=['blogly', 'upgrade-db'])
+            self.assertEqual(result.exit_code, 0, result.stderr)
+            self.assertIn('added users.version', result.stderr)
+            self.assertIn('created index ix_posts_created_id', result.stderr)
+            self.assertEqual(runner.invoke(args=['blogly', 'upgrade-db']).exit_code, 0)
+            with old.app_context():
+                self.assertEqual((User.query.get(1).post_count, Tag.query.get(1).post_count), (1, 1))
+                with old.test_client() as client:
+                    self.assertIn('Timer, Old', client.get('/users').get_data(as_text=True))
+                    self.assertIn('Before', client.get('/search?q=written').get_data(as_text=True))
+                    resp = client.post('/posts/1/edit', data=dict(title='After', content='', version=1))
+                    self.assertEqual(resp.status_code, 302)
+                db.session.remove()
+                db.engine.dispose()
+
+
+    def test_create_app_does_not_touch_the_database(self):
+        connections = []
+        listener = lambda *args: connections.append(1)
+        event.listen(Engine, 'connect', listener)
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                uri = f"sqlite:///{os.path.join(directory, 'fresh.db')}"
+                fresh = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+                self.assertEqual(connections, [])
+                self.assertIsNot(fresh.extensions['blogly_cache'], app.extensions['blogly_cache'])
+                runner = fresh.test_cli_runner(mix_stderr=False)
+                self.assertEqual(runner.invoke(args=['blogly', 'init-db']).exit_code, 0)
+                with fresh.app_context():
+                    self.assertIn('users', inspect(db.engine).get_table_names())
+                    db.engine.dispose()
+                self.assertEqual(runner.invoke(args=['blogly', 'drop-db', '--yes']).exit_code, 0)
+                with fresh.app_context():
+                    self.assertEqual(inspect(db.engine).get_table_names(), [])
+                    db.engine.dispose()
+        finally:
+            event.remove(Engine, 'connect', listener)
+        self.assertTrue(connections)
+
+
+    def test_reads_go_to_the_replica_until_the_client_writes(self):
+        directory = tempfile.mkdtemp()
+        primary, replica = (f"sqlite:///{os.path.join(directory, name)}" for name in ('primary.db', 'replica.db'))
+        replicated = create_app({'SQLALCHEMY_DATABASE_URI': primary, 'SQLALCHEMY_REPLICA_URI': replica})
+        try:
+            with replicated.app_context():
+                db.session.remove()
+                db.create_all()
+                replica_engine = db.get_engine(replicated, bind='replica')
+                db.Model.metadata.create_all(replica_engine)
+                db.session.add(User(id=1, first_name='Primary', last_name='Copy'))
+                db.session.commit()
+                replica_engine.execute(User.__table__.insert(), dict(id=1, first_name='Lagging', last_name='Copy'))
+
+                replica_engine.execute(Post.__table__.insert(), dict(id=1, title='Replicated', content='c', user_id=1,
+                                                                     created_at=datetime(2021, 7, 1)))
+                older = f'/users/1?after={encode_cursor([datetime(2021, 8, 1), 0])}'
+
+                writes = []
+                record = lambda conn, cursor, statement, *args: writes.append(statement)
+                event.listen(replica_engine, 'before_cursor_execute', record)
+                cache = replicated.extensions['blogly_cache']
+                client, other = replicated.test_client(), replicated.test_client()
+                self.assertIn('Replicated', client.get(older).get_data(as_text=True))
+                self.assertIn('Primary', client.get('/users/1').get_data(as_text=True))
+                self.assertIn('Primary', other.get('/users/1').get_data(as_text=True))
+                self.assertEqual(cache.hits['user_page'], 1)
+                self.assertNotIn('Lagging', client.get('/users/1/edit').get_data(as_text=True))
+                resp = client.post('/users/1/edit', data=dict(first_name='Edited', version=1))
+                self.assertIn('blogly_primary=', resp.headers['Set-Cookie'])
+                self.assertIn('Replicated', other.get(older).get_data(as_text=True))
+                self.assertNotIn('Replicated', client.get(older).get_data(as_text=True))
+                self.assertIn('Edited', other.get('/users/1').get_data(as_text=True))
+                self.assertIn('Edited', client.get('/users/1').get_data(as_text=True))
+                event.remove(replica_engine, 'before_cursor_execute', record)
+                self.assertFalse([statement for statement in writes if not statement.lstrip().startswith('SELECT')])
+                db.session.remove()
+                db.get_engine(replicated).dispose()
+                replica_engine.dispose()
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_pool_metrics(self):
+        with app.test_client() as client:
+            client.get('/users')
+            html = client.get('/metrics').get_data(as_text=True)
+            self.assertIn('# TYPE blogly_db_pool_checkouts_total counter', html)
+            checkouts = re.search(r'^blogly_db_pool_checkouts_total (\d+)$', html, re.M).group(1)
+            self.assertGreater(int(checkouts), 0)
+
+
+    def test_request_metrics_and_profiling(self):
+        with tempfile.TemporaryDirectory() as profile_dir:
+            app.config.update(PROFILING_ENABLED=True, PROFILE_DIR=profile_dir)
+            try:
+                with app.test_client() as client:
+                    client.get('/tags')
+                    resp = client.get('/search?q=anything', headers={'X-Profile': '1'})
+                    html = client.get('/metrics').get_data(as_text=True)
+            finally:
+                app.config['PROFILING_ENABLED'] = False
+            stats = pstats.Stats(os.path.join(profile_dir, resp.headers['X-Profile-File']))
+            self.assertTrue(any(name == 'search' for _, _, name in stats.stats))
+
+        self.assertIn('# TYPE blogly_request_duration_seconds histogram', html)
+        self.assertIn('blogly_request_duration_seconds_bucket{endpoint="blogly.show_tags",le="+Inf"}', html)
+        searches = re.search(r'^blogly_request_queries_count\{endpoint="blogly.search"\} (\d+)$', html, re.M)
+        self.assertGreaterEqual(int(searches.group(1)), 1)
+        template_time = re.search(r'^blogly_request_template_seconds_sum\{endpoint="blogly.search"\} (\S+)$', html, re.M)
+        self.assertGreater(float(template_time.group(1)), 0)
+
+
+    def test_export_and_import_round_trip(self):
+        user = self.make_user()
+        post = Post(title='Exported', content='Round\r\ntrip.\n', created_at=datetime(2021, 7, 4, 12, 30), user_id=user.id)
+        post.tags = [Tag(name='portable'), Tag(name='bulk')]
+        empty = Post(title='Empty', content='', created_at=datetime(2021, 7, 5), user_id=user.id)
+        db.session.add_all([post, empty])
+        db.session.commit()
+        user_id, post_id, empty_id = user.id, post.id, empty.id
+        runner = app.test_cli_runner(mix_stderr=False)
+
+        for fmt in ('jsonl', 'csv'):
+            exported = runner.invoke(args=['blogly', 'export', '--format', fmt], catch_exceptions=False)
+            self.assertIn('1 users', exported.stderr)
+            User.query.delete()
+            Tag.query.filter(Tag.name.in_(['portable', 'bulk'])).delete(synchronize_session=False)
+            db.session.commit()
+
+            result = runner.invoke(args=['blogly', 'import', '--format', fmt, '--chunk-size', '2', '-'],
+                                   input=exported.stdout_bytes, catch_exceptions=False)
+            self.assertEqual(result.exit_code, 0)
+            post = Post.query.get(post_id)
+            self.assertEqual((post.user_id, post.title, post.content), (user_id, 'Exported', 'Round\r\ntrip.\n'))
+            self.assertEqual(post.created_at, datetime(2021, 7, 4, 12, 30))
+            self.assertEqual(sorted(tag.name for tag in post.tags), ['bulk', 'portable'])
+            self.assertEqual(Post.query.get(empty_id).content, '')
+            self.assertEqual(User.query.get(user_id).first_name, 'Brian')
+        Tag.query.filter(Tag.name.in_(['portable', 'bulk'])).delete(synchronize_session=False)
+        db.session.commit()
+
+
+    def test_failed_import_still_moves_the_sequences(self):
+        user = self.make_user()
+        records = [dict(type='tag', name='fresh'), dict(type='user', id=user.id, first_name='A', last_name='B')]
+        source = ''.join(json.dumps(record) + '\n' for record in records)
+        runner = app.test_cli_runner(mix_stderr=False)
+        with mock.patch.object(Importer, 'finish') as finish:
+            result = runner.invoke(args=['blogly', 'import', '--chunk-size', '1', '-'], input=source)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('chunk 2 was rejected', result.stderr)
+        finish.assert_called_once()
+
+        for source in ('{"type": "user", "first_name": "A"}\n', '{"type": "user",\n',
+                       '{"type": "post", "user_id": "x", "title": "t", "content": ""}\n'):
+            result = runner.invoke(args=['blogly', 'import', '-'], input=source)
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn('chunk 1 has a bad record', result.stderr)
+        Tag.query.filter_by(name='fresh').delete()
+        db.session.commit()
+
+
+    def test_feed_is_newest_first_and_paginated(self):
+        user = self.make_user()
+        stamps = [datetime(2021, 7, day, 9) for day in (1, 2, 3, 3, 5)]
+        db.session.add_all(Post(title=f'Post {n}', content='not listed', created_at=stamp, user_id=user.id)
+                           for n, stamp in enumerate(stamps))
+        db.session.commit()
+        user_id = user.id
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        app.config['POSTS_PER_PAGE'] = 2
+        try:
+            with app.test_client() as client:
+                titles = []
+                link = '/posts'
+                event.listen(db.engine, 'before_cursor_execute', record)
+                try:
+                    while link:
+                        html = client.get(link).get_data(as_text=True)
+                        titles += re.findall(r'>(Post \d)</a>', html)
+                        link = re.search(r'href="(/posts\?after=[^"]+)"', html)
+                        link = link and link.group(1).replace('&amp;', '&')
+                finally:
+                    event.remove(db.engine, 'before_cursor_execute', record)
+                self.assertEqual(titles, ['Post 4', 'Post 3', 'Post 2', 'Post 1', 'Post 0'])
+                self.assertFalse([s for s in statements if 'posts.content' in s])
+                self.assertFalse([s for s in statements if 'count(' in s.lower()])
+                self.assertIn('on Jul 05, 2021', client.get('/posts').get_data(as_text=True))
+
+                html = client.get(f'/users/{user_id}').get_data(as_text=True)
+                self.assertEqual(re.findall(r'>(Post \d)</a>', html), ['Post 4', 'Post 3'])
+                older = re.search(r'href="(/users/\d+\?after=[^"]+)"', html).group(1)
+                html = client.get(older).get_data(as_text=True)
+                self.assertEqual(re.findall(r'>(Post \d)</a>', html), ['Post 2', 'Post 1'])
+                newer = re.search(r'href="(/users/\d+\?before=[^"]+)"', html).group(1)
+                html = client.get(newer).get_data(as_text=True)
+                self.assertEqual(re.findall(r'>(Post \d)</a>', html), ['Post 4', 'Post 3'])
+
+                for values in ([[1], 2], [{'dt': 'not a date'}, 2], ['2021-07-05T09:00:00', 2],
+                               [{'dt': '2021-07-05T09:00:00'}, '2']):
+                    cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+                    for path in ('/posts', f'/users/{user_id}'):
+                        resp = client.get(f'{path}?after={cursor}')
+                        self.assertEqual(resp.status_code, 200)
+                        self.assertEqual(re.findall(r'>(Post \d)</a>', resp.get_data(as_text=True)), ['Post 4', 'Post 3'])
+        finally:
+            app.config['POSTS_PER_PAGE'] = 20
+
+
+    def test_post_counters(self):
+        user = self.make_user()
+        db.session.add_all([Tag(name='rare'), Tag(name='common')])
+        db.session.commit()
+        user_id = user.id
+        with app.test_client() as client:
+            client.post(f'/users/{user_id}/posts/new', data=dict(title='a', content='a', tag=['common']))
+            client.post(f'/users/{user_id}/posts/new', data=dict(title='b', content='b', tag=['common', 'rare']))
+            self.assertIn('Ramirez, Brian</a> <span class="count">(2 posts)', client.get('/users').get_data(as_text=True))
+            html = client.get('/tags?sort=popular').get_data(as_text=True)
+            self.assertLess(html.index('>common</a> <span class="count">(2)'), html.index('>rare</a> <span class="count">(1)'))
+
+            post_id = Post.query.filter_by(title='b').one().id
+            client.get(f'/posts/{post_id}/delete')
+            self.assertEqual(Tag.query.filter_by(name='rare').one().post_count, 0)
+            self.assertEqual(User.query.get(user_id).post_count, 1)
+            client.get(f'/users/{user_id}/delete')
+            self.assertEqual(Tag.query.filter_by(name='common').one().post_count, 0)
+
+        user = self.make_user()
+        self.make_post(user.id)
+        runner = app.test_cli_runner(mix_stderr=False)
+        self.assertEqual(runner.invoke(args=['blogly', 'recount', '--check']).exit_code, 1)
+        self.assertIn('stored 0, actual 1', runner.invoke(args=['blogly', 'recount']).stdout)
+        self.assertEqual(runner.invoke(args=['blogly', 'recount', '--check']).exit_code, 0)
+        Tag.query.filter(Tag.name.in_(['rare', 'common'])).delete(synchronize_session=False)
+        db.session.commit()
+
+
+    def test_avatar_proxy(self):
+        png = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8DwHwAFBQIAX8jx0gAAAABJRU5ErkJggg==')
+        hits = []
+
+        class ImageHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                hits.append(self.path)
+                if self.path == '/garbage':
+                    self.wfile.write(b'garbage\r\n\r\n')
+                    return
+                if self.path == '/elsewhere':
+                    self.send_response(302)
+                    self.send_header('Location', f'http://localhost:{server.server_port}/me.png')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(png)))
+                self.end_headers()
+                self.wfile.write(png)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), ImageHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        source = f'http://127.0.0.1:{server.server_port}/me.png'
+        user = User(first_name='Ada', last_name='Lovelace', image_url=source)
+        plain = User(first_name='Plain', last_name='Jane')
+        local = User(first_name='Local', last_name='File', image_url='file:///etc/passwd')
+        db.session.add_all([user, plain, local])
+        db.session.commit()
+        user_id, plain_id, local_id = user.id, plain.id, local.id
+        avatar_store = app.extensions['blogly_avatars']
+        directory, avatar_store.directory = avatar_store.directory, tempfile.mkdtemp()
+        try:
+            with app.test_client() as client:
+                html = client.get(f'/users/{user_id}').get_data(as_text=True)
+                link = re.search(r'<img src="([^"]+)"', html).group(1)
+                self.assertIn(f'/avatars/{user_id}?v=', link)
+                private = client.get(link)
+                self.assertEqual(hits, [])
+                with self.assertRaisesRegex(AvatarError, 'not a public address'):
+                    fetch_image(f'http://127.0.0.1:{server.server_port}/elsewhere', allowed_hosts={'127.0.0.1'})
+                with self.assertRaises(AvatarError):
+                    fetch_image(f'http://127.0.0.1:{server.server_port}/garbage', allowed_hosts={'127.0.0.1'})
+                self.assertEqual(hits, ['/elsewhere', '/garbage'])
+                hits.clear()
+                avatar_store.allowed_hosts = {'127.0.0.1'}
+                remembered = client.get(link)
+                self.assertEqual(hits, [])
+                avatar_store.retry_after = 0
+                first = client.get(link)
+                second = client.get(link)
+                default = client.get(f'/avatars/{plain_id}')
+                refused = client.get(f'/avatars/{local_id}')
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(avatar_store.directory)
+            avatar_store.directory = directory
+            avatar_store.allowed_hosts = frozenset()
+            avatar_store.retry_after = app.config['AVATAR_RETRY_AFTER']
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.mimetype, 'image/png')
+        self.assertEqual(first.cache_control.max_age, app.config['AVATAR_MAX_AGE'])
+        self.assertEqual(second.get_data(), first.get_data())
+        self.assertEqual(hits, ['/me.png'])
+        for response in (private, remembered, default, refused):
+            self.assertEqual(response.mimetype, 'image/svg+xml')
+            self.assertIn(b'<svg', response.get_data())
+
+
+    @skipUnless(find_spec('aiosqlite'), 'the async views need aiosqlite')
+    def test_asgi_pages_match_flask(self):
+        from asgi import BloglyASGI
+
+        user = self.make_user()
+        post = Post(title='Async', content='Served from the loop.', created_at=datetime.now(), user_id=user.id)
+        tag = Tag(name='asgi')
+        post.tags.append(tag)
+        db.session.add(post)
+        db.session.commit()
+        paths = ['/users', '/posts', f'/users/{user.id}', f'/posts/{post.id}', '/tags', f'/tags/{tag.id}']
+
+        async def fetch(application, path):
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': []}
+            await application(scope, receive, send)
+            await application.engine.dispose()
+            return messages[0]['status'], b''.join(m.get('body', b'') for m in messages[1:])
+
+        application = BloglyASGI(app, config('TEST_DB'))
+        served = [asyncio.run(fetch(application, path)) for path in paths]
+        self.assertEqual(asyncio.run(fetch(application, '/posts/0'))[0], 302)
+        with app.test_client() as client:
+            for path, (status, body) in zip(paths, served):
+                self.assertEqual(status, 200)
+                self.assertEqual(body, client.get(path).get_data())
+        Tag.query.filter(Tag.name.in_(['asgi'])).delete(synchronize_session=False)
+        db.session.commit()
+
+
+class CacheTestCase(TestCase):
+    def test_lru_evicts_least_recently_used(self):
+        lru = LRUCache(maxsize=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIs(lru.get('b'), MISSING)
+        self.assertEqual(lru.get('c'), 3)
+
+
+    def test_lru_entries_expire(self):
+        lru = LRUCache(maxsize=2, ttl=60)
+        lru.set('a', 1, ttl=-1)
+        self.assertIs(lru.get('a'), MISSING)
+
+
+    def test_shared_backend_and_namespaces(self):
+        cache = Cache(SharedCache(LocalSharedClient()))
+        loads = []
+        def loader():
+            loads.append(1)
+            return {'name': 'x'}
+
+        self.assertEqual(cache.get_or_load('tag', 1, loader), {'name': 'x'})
+        self.assertEqual(cache.get_or_load('tag', 1, loader), {'name': 'x'})
+        self.assertEqual((len(loads), cache.hits['tag'], cache.misses['tag']), (1, 1, 1))
+
+        cache.invalidate('tag', 1)
+        cache.get_or_load('tag', 1, loader)
+        cache.invalidate('tag')
+        cache.get_or_load('tag', 1, loader)
+        self.assertEqual(len(loads), 3)
+
+
+    def test_local_cache_is_off_with_several_workers(self):
+        settings = dict(CACHE_BACKEND='local', CACHE_MAXSIZE=1024, CACHE_TTL=300, WEB_CONCURRENCY=1)
+        self.assertEqual(make_cache_backend(settings).maxsize, 1024)
+        settings['WEB_CONCURRENCY'] = 4
+        backend = make_cache_backend(settings)
+        backend.set('a', 1)
+        self.assertIs(backend.get('a'), MISSING)
+
+
+    def test_invalidation_during_a_load_is_not_lost(self):
+        cache = Cache(LRUCache())
+        for namespace_wide in (False, True):
+            cache.clear()
+            def loader():
+                cache.invalidate('tag', None if namespace_wide else 1)
+                return 'stale'
+
+            self.assertEqual(cache.get_or_load('tag', 1, loader), 'stale')
+            self.assertIsNone(cache.get('tag', 1))
@@ -0,0 +1,17 @@
+"""WSGI entry point for Blogly.
+
+    WEB_CONCURRENCY=4 gunicorn --preload wsgi:app
+
+Importing this module builds the app but opens no database
+connection, so with --preload the workers are forked from a
+process that holds none and each opens its own pool on its
+first request. Set the worker count through WEB_CONCURRENCY
+rather than --workers, so the app knows to turn its local
+cache off. Create the tables beforehand with:
+
+    FLASK_APP=app flask blogly init-db
+"""
+from app import create_app
+
+
+app = create_app()